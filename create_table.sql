@@ -1,6 +1,8 @@
 -- Table names are flush left, and column definitions are
 -- indented by at least one space or tab. Blank lines and
 -- lines beginning with a double hyphen are comments.
+-- Flush-left lines beginning "create " (eg indexes) are run
+-- as they are, so they need to say "if not exists".
 
 tracks
 	id serial primary key
@@ -21,6 +23,7 @@ tracks
 	comments varchar not null default ''
 	enqueued int not null default 0
 	played int not null default 0
+	last_played timestamptz
 	sequence int not null default 0
 	keywords varchar not null default ''
 	url varchar not null default ''
@@ -41,3 +44,30 @@ outreach
 	message varchar not null default ''
 	created timestamptz not null default now()
 	processed int not null default 0
+
+queue
+	id serial primary key
+	track_id int not null
+	userid int not null default 0
+	requested timestamptz not null default now()
+	played timestamptz -- null until the renderer takes it
+
+-- Every couplet of every track's lyrics, for the Oracle to search
+-- (see database.index_track). Rebuilt whenever a track changes.
+couplets
+	id serial primary key
+	track_id int not null
+	couplet text not null
+	words tsvector not null -- of the couplet
+	keywords tsvector not null -- of the track's keywords
+	counted boolean not null default false -- words are in wordcounts (track is active)
+create index if not exists couplets_track_id on couplets (track_id)
+create index if not exists couplets_words on couplets using gin (words)
+create index if not exists couplets_keywords on couplets using gin (keywords)
+
+-- How often each word comes up in the couplets of active tracks,
+-- for the Oracle's word cloud. Kept up to date by index_track.
+wordcounts
+	word varchar primary key
+	count int not null default 0
+create index if not exists wordcounts_count on wordcounts (count)
@@ -24,9 +24,9 @@ if arguments.server == "renderer":
 	from . import renderer
 	renderer.run() # doesn't return
 elif arguments.server == "major_glitch":
-	from . import renderer
-	renderer.major_glitch()
-	logging.info("Major Glitch built successfully.")
+	from . import majorglitch
+	reused, rebuilt = majorglitch.render()
+	logging.info("Major Glitch built successfully (%d segments reused, %d rebuilt).", reused, rebuilt)
 else:
 	from . import server
 	server.run(disable_logins=arguments.dev) # doesn't return
@@ -0,0 +1,61 @@
+"""Beat analysis for the renderer
+
+Running amen over a track means decoding it all over again and then doing
+the beat tracking, which is far and away the most expensive part of getting
+a track ready to play. All the renderer ever looks at is the beat grid, so
+that gets boiled down to a compact string and kept in tracks.analysis; it is
+recomputed only if the audio file changes or the analyzer VERSION is bumped.
+"""
+import json
+import logging
+import amen.audio
+
+log = logging.getLogger(__name__)
+
+# Bump this whenever the analysis changes (new amen, different parameters,
+# anything that could move a beat) and every track will be reanalyzed the
+# next time it comes up.
+VERSION = 1
+
+class Analysis(object):
+	"""The parts of an amen analysis that the renderer cares about
+
+	duration: Length of the track in seconds (float)
+
+	beats: List of (time, duration) pairs, in nanoseconds
+	"""
+	def __init__(self, duration, beats):
+		self.duration = duration
+		self.beats = beats
+
+def analyse(filename):
+	"""Run amen over the given file. Slow."""
+	audio = amen.audio.Audio(filename)
+	beats = [(b.time.value, b.duration.value) for b in audio.timings['beats']]
+	return Analysis(audio.duration, beats)
+
+def dump(analysis, source):
+	"""Serialize an Analysis, tagged with the source file's signature
+
+	Beat times are stored as deltas from the previous beat, which keeps
+	the numbers (and thus the string) small.
+	"""
+	deltas = []; prev = 0
+	for time, duration in analysis.beats:
+		deltas.append((time - prev, duration))
+		prev = time
+	return json.dumps({"v": VERSION, "src": source, "duration": analysis.duration, "beats": deltas},
+		separators=(",", ":"))
+
+def load(data, source):
+	"""Deserialize an Analysis, or return None if it's stale or unusable"""
+	if not data: return None
+	try: info = json.loads(data)
+	except ValueError: return None
+	if not isinstance(info, dict) or info.get("v") != VERSION or info.get("src") != source:
+		return None
+	beats = []; time = 0
+	for delta, duration in info["beats"]:
+		time += delta
+		beats.append((time, duration))
+	return Analysis(info["duration"], beats)
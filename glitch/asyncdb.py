@@ -0,0 +1,108 @@
+"""Non-blocking database access for the renderer
+
+The renderer's event loop feeds every listener, so it mustn't ever wait on a
+query. This is the part of glitch.database that the renderer needs, on a
+small aiopg connection pool; the Flask server keeps using glitch.database.
+"""
+import asyncio
+import logging
+import aiopg
+from . import apikeys, config, database
+
+log = logging.getLogger(__name__)
+
+_pool = None # Future for the pool, created on first use
+
+async def _get_pool():
+	global _pool
+	# Keep hold of the future before awaiting anything, so that everyone
+	# who asks while it's being created waits for the same pool.
+	if _pool is None:
+		_pool = asyncio.ensure_future(aiopg.create_pool(apikeys.db_connect_string,
+			minsize=1, maxsize=config.async_db_pool_size))
+	pool = _pool
+	try:
+		return await asyncio.shield(pool)
+	except Exception:
+		# Try again next time, rather than failing forever.
+		if _pool is pool and pool.done(): _pool = None
+		raise
+
+async def _fetchone(query, args=()):
+	pool = await _get_pool()
+	async with pool.acquire() as conn:
+		async with conn.cursor() as cur:
+			await cur.execute(query, args)
+			return await cur.fetchone()
+
+async def _fetchall(query, args=()):
+	pool = await _get_pool()
+	async with pool.acquire() as conn:
+		async with conn.cursor() as cur:
+			await cur.execute(query, args)
+			return await cur.fetchall()
+
+async def _execute(query, args=()):
+	pool = await _get_pool()
+	async with pool.acquire() as conn:
+		async with conn.cursor() as cur:
+			await cur.execute(query, args)
+
+async def claim_request():
+	"""Take the oldest listener request off the queue
+
+	Returns None if there are none, else (track ID, Track), where the Track
+	is None if it is no longer available.
+	"""
+	row = await _fetchone(database.CLAIM_REQUEST)
+	if not row: return None
+	return row[0], (database.Track(*row[1:]) if row[1] is not None else None)
+
+async def notifications(channel):
+	"""Yield the payload of every notification on a channel, forever
+
+	Yields None first, as soon as it's listening, so the caller can catch up
+	on whatever happened before then. This holds a connection of its own
+	(outside the pool) for as long as it's being iterated.
+	"""
+	async with aiopg.connect(apikeys.db_connect_string) as conn:
+		async with conn.cursor() as cur:
+			await cur.execute("LISTEN " + channel)
+		yield None
+		while True:
+			yield (await conn.notifies.get()).payload
+
+async def get_analysis(id):
+	"""Get a track's stored analysis, or '' if none (or no such track)"""
+	row = await _fetchone("select analysis from tracks where id=%s", (id,))
+	return row[0] if row else ""
+
+async def save_analysis(id, analysis):
+	await _execute("update tracks set analysis=%s where id=%s", (analysis, id))
+
+async def get_active_track(id):
+	"""Get a track by ID, or None if it isn't active"""
+	row = await _fetchone("SELECT "+database.Track.columns+" FROM tracks WHERE id=%s AND status=1", (id,))
+	return row and database.Track(*row)
+
+async def get_schedule(ids=None):
+	"""Get (id, played, last_played) for active tracks (or just the given ones)
+
+	last_played is a Unix time, or 0 if never.
+	"""
+	query = "SELECT id, played, coalesce(extract(epoch from last_played), 0) FROM tracks WHERE status=1"
+	if ids is None: return await _fetchall(query)
+	return await _fetchall(query + " AND id=any(%s)", (list(ids),))
+
+async def get_active_ids():
+	return {row[0] for row in await _fetchall("SELECT id FROM tracks WHERE status=1")}
+
+async def record_plays(plays):
+	"""Save play history in one go
+
+	plays: dict mapping track ID to (number of plays, time of the last one)
+	"""
+	ids = list(plays)
+	await _execute("""UPDATE tracks SET played=played+v.n, last_played=to_timestamp(v.t)
+		FROM unnest(%s::int[], %s::int[], %s::float8[]) AS v(id, n, t) WHERE tracks.id=v.id""",
+		(ids, [plays[id][0] for id in ids], [plays[id][1] for id in ids]))
@@ -0,0 +1,402 @@
+"""Encoded-stream buffering for the renderer's listeners
+
+The mixer's PCM is fed to one or more Streams, each an ffmpeg encoder with its
+own format and bitrate. An encoder's output goes into a RingBuffer: a
+fixed-size, preallocated bytearray, carved up into chunks that are numbered
+sequentially. Chunks always end on a frame boundary (found by actually parsing
+the MP3 frame headers or Ogg pages), so any chunk is a valid place for a
+listener to start. Listeners are handed memoryviews straight into the buffer -
+no copying, however many of them there are. Once the buffer fills up, the
+oldest chunks are overwritten.
+
+Each chunk also carries an index of its frames, so that a position in the
+stream (in seconds of audio) can be turned into a byte offset. A Timeline
+then relates stream positions to the wall-clock time they should be heard,
+which is how listeners get started at "now" rather than at some arbitrary
+point in the buffer.
+"""
+import array
+import asyncio
+import bisect
+import collections
+import logging
+import subprocess
+from . import config, pcmcache
+
+log = logging.getLogger(__name__)
+
+# MPEG audio layer III bitrates (kbps) by bitrate index, for MPEG-1 and for
+# MPEG-2/2.5; and sample rates by version ID (0 = 2.5, 2 = 2, 3 = 1).
+_BITRATES = {
+	3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+	2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+def mp3_frame(header):
+	"""Parse an MP3 frame header
+
+	header: At least four bytes, starting where a frame might be
+
+	Returns (frame length in bytes, samples per channel, sample rate), or
+	None if this isn't the start of a valid MPEG audio layer III frame.
+	"""
+	if header[0] != 0xFF or header[1] & 0xE0 != 0xE0: return None
+	version = (header[1] >> 3) & 3
+	layer = (header[1] >> 1) & 3
+	if version == 1 or layer != 1: return None # Reserved version, or not layer III
+	bitrate = header[2] >> 4
+	rate = (header[2] >> 2) & 3
+	if bitrate in (0, 15) or rate == 3: return None # Free-format or invalid
+	padding = (header[2] >> 1) & 1
+	kbps = _BITRATES[3 if version == 3 else 2][bitrate]
+	hz = _SAMPLE_RATES[version][rate]
+	if version == 3: return 144000 * kbps // hz + padding, 1152, hz
+	return 72000 * kbps // hz + padding, 576, hz
+
+def id3_length(header):
+	"""Return the total length of an ID3v2 tag, given its ten-byte header, or None"""
+	if header[:3] != b"ID3": return None
+	size = (header[6] & 0x7F) << 21 | (header[7] & 0x7F) << 14 | (header[8] & 0x7F) << 7 | header[9] & 0x7F
+	return size + (20 if header[5] & 0x10 else 10) # With or without footer
+
+class MP3Framer(object):
+	"""Frame parser for MP3 streams"""
+	content_type = "audio/mpeg"
+	rate = 0
+
+	def frame(self, data):
+		"""Measure the frame at the start of data
+
+		Returns (length, samples), or None if more data is needed. Anything
+		unrecognizable is reported as a one-byte frame with no samples.
+		"""
+		if len(data) < 10: return None
+		length = id3_length(data)
+		samples = 0
+		if length is None:
+			frame = mp3_frame(data)
+			if not frame:
+				# Not a frame header. Skip a byte and try to resync.
+				log.debug("Junk in MP3 stream")
+				return 1, 0
+			length, samples, self.rate = frame
+		if length > len(data): return None # Wait for the rest of it
+		return length, samples
+
+class OggFramer(object):
+	"""Page parser for Ogg Opus streams"""
+	content_type = "audio/ogg"
+	rate = 48000 # Opus granule positions always count at 48KHz
+
+	def __init__(self):
+		self.granule = 0
+
+	def frame(self, data):
+		"""Measure the page at the start of data (see MP3Framer.frame)"""
+		if len(data) < 27: return None
+		if data[:4] != b"OggS": return 1, 0
+		segments = data[26]
+		if len(data) < 27 + segments: return None
+		length = 27 + segments + sum(data[27:27 + segments])
+		if length > len(data): return None
+		granule = int.from_bytes(data[6:14], "little", signed=True)
+		if granule == -1: return length, 0 # No packet ends on this page
+		samples = max(granule - self.granule, 0)
+		self.granule = granule
+		return length, samples
+
+class Timeline(object):
+	"""Relationship between stream position and wall-clock time
+
+	start: Wall-clock time (time.time()) at which the stream begins
+
+	Normally, each second of the stream is heard a second after the one
+	before it. If the renderer stalls for too long, though, the rest of the
+	stream is pushed back to start again from the present (see pacing.py),
+	and an anchor records where that happened.
+	"""
+	def __init__(self, start):
+		# Parallel lists: the stream position at each anchor, and when
+		# it is to be heard. Both ascending.
+		self.positions = [0.0]
+		self.walls = [start]
+
+	def anchor(self, position, wall_time):
+		"""Have the stream from this position onward heard from this time"""
+		self.positions.append(position)
+		self.walls.append(wall_time)
+
+	def trim(self, wall_time):
+		"""Forget anchors that only affect what was heard before this time"""
+		idx = bisect.bisect_right(self.walls, wall_time) - 1
+		if idx > 0:
+			del self.positions[:idx]
+			del self.walls[:idx]
+
+	def wall_time(self, position):
+		"""When should this stream position (seconds) be heard?"""
+		idx = max(bisect.bisect_right(self.positions, position) - 1, 0)
+		return self.walls[idx] + position - self.positions[idx]
+
+	def position(self, wall_time):
+		"""What stream position should be heard at this time?"""
+		idx = max(bisect.bisect_right(self.walls, wall_time) - 1, 0)
+		position = self.positions[idx] + wall_time - self.walls[idx]
+		# In the gap before an anchor, it's still the anchor's position
+		# that's next up; the stream just hasn't got there yet.
+		if idx + 1 < len(self.positions): position = min(position, self.positions[idx + 1])
+		return position
+
+class Chunk(object):
+	"""One published chunk of a RingBuffer
+
+	start, end: Location in the buffer
+
+	first_sample: Stream position of the chunk's first frame, in samples
+
+	samples: Number of samples in the chunk
+
+	offsets, positions: For each frame, its byte offset within the chunk
+	and its sample position relative to first_sample
+	"""
+	__slots__ = ("start", "end", "first_sample", "samples", "offsets", "positions")
+	def __init__(self, start, end, first_sample, samples, offsets, positions):
+		self.start = start; self.end = end
+		self.first_sample = first_sample; self.samples = samples
+		self.offsets = offsets; self.positions = positions
+
+	def frame_at(self, sample):
+		"""Byte offset of the first frame that ends after the given sample
+
+		sample: Position relative to the start of the chunk
+		"""
+		idx = bisect.bisect_right(self.positions, sample) - 1
+		if idx < 0: return 0
+		return self.offsets[idx]
+
+	def position_at(self, offset):
+		"""Sample position (relative to the chunk) of the frame at or after offset"""
+		idx = bisect.bisect_left(self.offsets, offset)
+		if idx >= len(self.positions): return self.samples
+		return self.positions[idx]
+
+class RingBuffer(object):
+	"""Fixed-capacity buffer of sequentially-numbered chunks of encoded audio
+
+	capacity: Size of the buffer in bytes
+
+	chunk_size: Minimum size of a chunk; chunks are published as soon as
+	this many bytes of complete frames are available.
+
+	framer: MP3Framer or OggFramer, as appropriate
+
+	Anything before the first frame of audio (ID3 tag, Ogg header pages) is
+	not part of any chunk; it's kept as the header, which every listener
+	needs to be sent before anything else.
+	"""
+	def __init__(self, capacity, chunk_size, framer):
+		self.buffer = bytearray(capacity)
+		self.view = memoryview(self.buffer)
+		self.chunk_size = chunk_size
+		self.framer = framer
+		self.header = None # Becomes bytes once the first audio frame arrives
+		self.chunks = collections.deque() # Chunk objects for everything still available
+		self.first_seq = 0 # Sequence number of self.chunks[0]
+		self.start = 0 # Beginning of the chunk being filled
+		self.scan = 0 # Next frame header to be parsed
+		self.fill = 0 # End of the data written so far
+		self.total_samples = 0 # Stream position (in samples) of self.start
+		self.rate = framer.rate # Sample rate, as found by the framer
+		# Frame index of the chunk being filled
+		self.samples = 0
+		self.offsets = array.array("L")
+		self.positions = array.array("L")
+		self._published = asyncio.Event()
+
+	@property
+	def duration(self):
+		"""Seconds of audio in the published chunks"""
+		if not self.chunks or not self.rate: return 0.0
+		return (self.total_samples - self.chunks[0].first_sample) / self.rate
+
+	@property
+	def next_seq(self):
+		"""Sequence number that the next chunk will get"""
+		return self.first_seq + len(self.chunks)
+
+	def _evict(self, lo, hi):
+		"""Discard every chunk overlapping [lo, hi), and everything older"""
+		while self.chunks and self.chunks[0].start < hi and self.chunks[0].end > lo:
+			self.chunks.popleft()
+			self.first_seq += 1
+
+	def write(self, data):
+		"""Append encoded data, publishing chunks as they are completed"""
+		n = len(data)
+		if self.fill + n > len(self.buffer):
+			# Out of room at the end. Move the incomplete chunk (which is
+			# usually rather small) to the front of the buffer and carry
+			# on from there. Anything still left beyond it is older than
+			# what's at the front, so it goes too.
+			partial = self.fill - self.start
+			if partial + n > len(self.buffer): raise ValueError("Ring buffer too small for its chunk size")
+			while self.chunks and self.chunks[0].start >= self.start:
+				self.chunks.popleft()
+				self.first_seq += 1
+			self._evict(0, partial + n)
+			self.buffer[:partial] = self.buffer[self.start:self.fill]
+			self.scan -= self.start
+			self.fill = partial
+			self.start = 0
+		else:
+			self._evict(self.fill, self.fill + n)
+		self.buffer[self.fill:self.fill + n] = data
+		self.fill += n
+		self._parse()
+
+	def _parse(self):
+		while True:
+			frame = self.framer.frame(self.view[self.scan:self.fill])
+			if frame is None: break
+			length, samples = frame
+			if samples:
+				if self.header is None:
+					self.header = bytes(self.view[self.start:self.scan])
+					self.start = self.scan
+				self.offsets.append(self.scan - self.start)
+				self.positions.append(self.samples)
+			self.scan += length
+			self.samples += samples
+			if self.header is not None and self.scan - self.start >= self.chunk_size: self._publish()
+		self.rate = self.framer.rate
+
+	def _publish(self):
+		self.chunks.append(Chunk(self.start, self.scan, self.total_samples, self.samples, self.offsets, self.positions))
+		self.start = self.scan
+		self.total_samples += self.samples
+		self.samples = 0
+		self.offsets = array.array("L")
+		self.positions = array.array("L")
+		self._published.set()
+		self._published = asyncio.Event()
+
+	def get(self, seq):
+		"""Get a chunk, or None if it has already been discarded"""
+		if seq < self.first_seq: return None
+		chunk = self.chunks[seq - self.first_seq]
+		return self.view[chunk.start:chunk.end]
+
+	def locate(self, position):
+		"""Find the frame that is playing at a given stream position
+
+		position: Seconds since the start of the stream
+
+		Returns (seq, offset). If the position is no longer available, this
+		will be the start of the oldest chunk; if it hasn't been reached yet,
+		it will be the start of the next chunk to be published.
+		"""
+		sample = int(position * self.rate)
+		for idx in range(len(self.chunks) - 1, -1, -1):
+			chunk = self.chunks[idx]
+			if chunk.first_sample <= sample:
+				if sample >= chunk.first_sample + chunk.samples: return self.first_seq + idx + 1, 0
+				return self.first_seq + idx, chunk.frame_at(sample - chunk.first_sample)
+		return self.first_seq, 0
+
+	def position(self, seq, offset):
+		"""Stream position (seconds) of the frame at seq/offset"""
+		if not self.rate: return 0.0
+		if seq >= self.next_seq: return self.total_samples / self.rate
+		chunk = self.chunks[max(seq - self.first_seq, 0)]
+		return (chunk.first_sample + chunk.position_at(offset)) / self.rate
+
+	def read(self, seq, offset, limit):
+		"""Get the frames of a chunk from offset up to a stream position
+
+		limit: Stream position (seconds); frames starting at or after it
+		are not included
+
+		Returns (data, end) where end is the offset to continue from; if it
+		is the length of the chunk, the next read should be from the next one.
+		"""
+		chunk = self.chunks[seq - self.first_seq]
+		sample = int(limit * self.rate) - chunk.first_sample
+		idx = bisect.bisect_left(chunk.positions, sample)
+		end = chunk.offsets[idx] if idx < len(chunk.offsets) else chunk.end - chunk.start
+		end = max(end, offset)
+		return self.view[chunk.start + offset : chunk.start + end], end
+
+	async def wait_for(self, seq):
+		"""Wait until the given chunk has been published"""
+		while seq >= self.next_seq:
+			await self._published.wait()
+
+class IcyInserter(object):
+	"""Interleave ICY metadata with one listener's MP3 stream
+
+	metaint: Audio bytes between metadata blocks
+
+	Audio is passed through as slices of whatever it came in as, so the
+	shared buffers are never copied.
+	"""
+	def __init__(self, metaint):
+		self.metaint = metaint
+		self.remaining = metaint # Audio bytes until the next block
+		self.last = None # Metadata most recently sent
+
+	def insert(self, data, metadata):
+		"""Yield the pieces to send for this data, with metadata blocks as needed
+
+		metadata: Encoded block for the audio being sent (or None if unknown).
+		The title is only actually sent when it changes.
+		"""
+		data = memoryview(data)
+		while len(data) >= self.remaining:
+			yield data[:self.remaining]
+			data = data[self.remaining:]
+			self.remaining = self.metaint
+			if metadata is None or metadata == self.last:
+				yield b"\0" # Empty block: no change
+			else:
+				yield metadata
+				self.last = metadata
+		if data:
+			yield data
+			self.remaining -= len(data)
+
+class Stream(object):
+	"""One encoded output: an encoder process and the RingBuffer it feeds
+
+	format: File extension, which is also what a listener asks for
+
+	bitrate: Nominal bitrate (kbps)
+
+	args: ffmpeg output options
+	"""
+	def __init__(self, format, bitrate, args):
+		self.format = format
+		self.bitrate = bitrate
+		self.args = args
+		framer = OggFramer() if format in ("ogg", "opus") else MP3Framer()
+		self.content_type = framer.content_type
+		self.ring = RingBuffer(config.ring_buffer_size, config.ring_chunk_size, framer)
+		self.process = None
+
+	async def start(self):
+		self.process = await asyncio.create_subprocess_exec("ffmpeg",
+			"-ac", str(pcmcache.CHANNELS), "-ar", str(pcmcache.FRAME_RATE), "-f", "s16le", "-i", "-",
+			*self.args, "-b:a", "%dk" % self.bitrate, "-",
+			stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+	async def pump(self):
+		"""Move encoded data into the ring buffer until the encoder finishes"""
+		try:
+			while self.process.returncode is None:
+				data = await self.process.stdout.read(65536)
+				if not data: break
+				self.ring.write(data)
+		finally:
+			if self.process.returncode is None:
+				log.warning("Terminating %s encoder due to renderer exception", self.format)
+				self.process.terminate()
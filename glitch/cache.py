@@ -0,0 +1,83 @@
+"""Shared cache for the web server's expensive pages
+
+The home page is built from every active track's lyrics, but those change
+only when someone edits the tracks. So what it needs is built once, and kept
+(pickled) in config.web_cache_dir, where every server process can use it.
+
+Everything in the cache is tagged with the generation it was built in, which
+is a random token in a marker file. The database functions that change
+tracks replace the marker once their changes are committed (see
+database._invalidates_cache), and everything built before that is thereby
+stale. Checking the generation costs reading that one tiny file, and a
+process keeps its own copy of whatever it has loaded, so a hit needn't even
+unpickle anything.
+"""
+import os
+import pickle
+import logging
+import threading
+from . import config, metrics, utils
+
+log = logging.getLogger(__name__)
+
+lookups = metrics.Counter("glitch_cache_lookups_total", "Cache lookups, by whether they were served from the cache", ["name", "result"])
+rebuilds = metrics.Histogram("glitch_cache_rebuild_seconds", "Time to rebuild a stale cache entry", ["name"])
+
+_local = {} # name: (generation, value) for everything this process has loaded
+
+def _marker():
+	return os.path.join(config.web_cache_dir, "generation")
+
+def _replace(fn, data):
+	"""Atomically replace a file in the cache directory"""
+	os.makedirs(config.web_cache_dir, exist_ok=True)
+	tmp = "%s.%d.%d.tmp" % (fn, os.getpid(), threading.get_ident())
+	with open(tmp, "wb") as f: f.write(data)
+	os.replace(tmp, fn)
+
+def invalidate():
+	"""Make everything cached stale
+
+	Call after committing any change that cached things might be built from.
+	"""
+	_replace(_marker(), utils.random_hex().encode("ascii"))
+
+def generation():
+	"""Identify the current generation; it changes on every invalidate()"""
+	# The marker is replaced, never rewritten, so this can't see half a token.
+	try:
+		with open(_marker()) as f: return f.read()
+	except FileNotFoundError:
+		invalidate()
+		return generation()
+
+def get(name, build):
+	"""Get something from the cache, building (and caching) it if need be
+
+	name: Identifies what's cached; also used as a file name
+
+	build: Function returning the value; it must be picklable
+	"""
+	gen = generation()
+	cached = _local.get(name)
+	if cached and cached[0] == gen:
+		lookups.labels(name, "hit").inc()
+		return cached[1]
+	fn = os.path.join(config.web_cache_dir, name + ".pickle")
+	try:
+		with open(fn, "rb") as f: cached = pickle.load(f)
+		if cached[0] == gen:
+			lookups.labels(name, "shared").inc()
+			_local[name] = cached
+			return cached[1]
+	except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+		pass
+	lookups.labels(name, "miss").inc()
+	# If it's invalidated while we're building it, it'll be stored with the
+	# old generation, and rebuilt again next time.
+	with rebuilds.labels(name).time():
+		value = build()
+	_local[name] = (gen, value)
+	_replace(fn, pickle.dumps((gen, value)))
+	log.debug("Rebuilt %s for generation %s", name, gen)
+	return value
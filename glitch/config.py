@@ -2,7 +2,7 @@
 # See also apikeys_sample.py for the configs which are _not_ git-managed.
 server_domain = "http://www.infiniteglitch.net"
 
-lag_limit = 88200        #   samples - how much we can lag by before dropping frames.
+lag_limit = 88200        #   samples - how much we can lag by before skipping ahead (see pacing.py)
 restart_timeout = 3      #   seconds between polls to restart.txt
 http_port = 8888
 mini_http_port = 8193
@@ -12,6 +12,61 @@ use_sudo_uid_gid = True # If set, uid/gid will be overridden with SUDO_UID/SUDO_
 frontend_buffer = 20    #   seconds of audio to buffer in frontend
 past_played_buffer = 600 #   seconds of audio to store track metadata for in the past
 drift_limit = 0.1        #   seconds of audio after which drift should be corrected
+pacing_block = 1.0       #   seconds of audio given to the encoders at a time
+sse_keepalive = 15       #   seconds between keepalives to idle /events subscribers
+
+# Decoded audio for the renderer (see pcmcache.py)
+pcm_cache_dir = "pcm_cache"
+pcm_cache_size = 4 * 1024 * 1024 * 1024 # bytes
+
+# Encoded audio kept in memory for listeners (see broadcast.py). A chunk of
+# 64KB is about four seconds at 128kbps.
+ring_buffer_size = 32 * 1024 * 1024 # bytes
+ring_chunk_size = 64 * 1024 # bytes
+stream_pace = 0.5        #   seconds between sends to a listener who has a full buffer
+icy_metaint = 16000      #   bytes of MP3 between track titles, for players sending Icy-MetaData
+
+# Encodings offered to listeners, as (format, bitrate in kbps, ffmpeg output
+# options). Every one of them costs an encoder process and a ring buffer. The
+# first one listed is the default for its format.
+streams = [
+	("mp3", 128, ["-f", "mp3"]),
+	("mp3", 64, ["-f", "mp3"]),
+	("opus", 96, ["-c:a", "libopus", "-f", "ogg"]),
+]
+
+# HLS output (see hls.py), from the mp3 stream closest to hls_bitrate. The
+# in-memory stream is still available either way.
+hls_dir = ""             #   directory for the playlist and segments; empty to disable
+hls_bitrate = 128        #   kbps
+hls_segment_time = 6     #   seconds per segment (shorter when a track starts)
+hls_list_size = 10       #   segments in the playlist
+
+prefetch_depth = 2       #   tracks to load ahead of the mixer
+prefetch_workers = 2     #   processes for decoding/analysing upcoming tracks
+prefetch_retry_limit = 60 #  seconds at most between retries when a track can't be picked
+db_pool_min = 1          #   database connections kept open (see database.py)
+db_pool_max = 10         #   database connections at most; more callers wait
+db_itersize = 500        #   rows per batch fetched by bulk track listings
+db_health_interval = 30  #   seconds idle after which a connection is checked before use
+user_cache_size = 1000   #   logged-in users to remember between requests (see database.User)
+user_cache_ttl = 60      #   seconds to remember them for
+# Listener requests (see database.enqueue_track)
+enqueue_user_limit = 3   #   requests a user may make...
+enqueue_user_window = 3600 # ...in this many seconds
+enqueue_track_limit = 1  #   requests for any one track that may be waiting to play, or played...
+enqueue_track_window = 3600 # ...in this many seconds (about 15-20 tracks). A time
+                         #   window, since the database doesn't know how many tracks have
+                         #   played since (the renderer saves plays in batches).
+
+repeat_window = 20       #   picks before a track may be picked again (see scheduler.py)
+history_batch = 10       #   plays to save to the database at a time
+scheduler_refresh = 300  #   seconds between checks for new or removed tracks
+async_db_pool_size = 4   #   connections for the renderer's database access (see asyncdb.py)
+
+major_glitch_workers = None # processes for rendering the Major Glitch (None for one per CPU)
+segment_cache_dir = "segment_cache" # mixed segments of the Major Glitch (as big as it is, in PCM)
+web_cache_dir = "web_cache" # pages and data shared between server processes (see cache.py)
 
 # Track limits in seconds
 max_track_length = 400
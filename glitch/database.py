@@ -5,11 +5,17 @@ Executable using 'python -m glitch.database' - use --help for usage.
 from flask_login import UserMixin
 from . import apikeys
 import psycopg2
-from . import utils
+import psycopg2.pool
+from . import config, utils, metrics, cache
+import collections
+import contextlib
+import functools
+import threading
 import logging
-import queue
+import time
 import os
 import re
+import string
 from mutagen.mp3 import MP3
 import clize
 
@@ -18,60 +24,169 @@ def cmdline(f):
 	commands.append(f)
 	return f
 
-_conn = psycopg2.connect(apikeys.db_connect_string)
 log = logging.getLogger(__name__)
 
+# Connections are checked out of a pool for each operation, so that any number
+# of threads can use this module at once. The pool itself refuses to hand out
+# more than its maximum, so the semaphore makes the excess wait their turn.
+_pool = psycopg2.pool.ThreadedConnectionPool(config.db_pool_min, config.db_pool_max, apikeys.db_connect_string)
+_pool_slots = threading.BoundedSemaphore(config.db_pool_max)
+_last_used = {} # id(conn): time.monotonic() when it was last returned to the pool
+
+pool_wait = metrics.Histogram("glitch_db_pool_wait_seconds", "Time spent waiting for a database connection")
+pool_in_use = metrics.Gauge("glitch_db_pool_in_use", "Database connections checked out")
+reconnects = metrics.Counter("glitch_db_reconnects_total", "Database connections found broken and replaced")
+
+def _checkout():
+	"""Get a connection from the pool that is (as far as we know) working"""
+	while True:
+		conn = _pool.getconn()
+		if not conn.closed and time.monotonic() - _last_used.get(id(conn), 0) < config.db_health_interval:
+			return conn # Used recently enough to trust
+		# It's been idle a while, and the server may have restarted
+		# since. Check it before handing it out.
+		try:
+			if not conn.closed:
+				with conn.cursor() as cur: cur.execute("select 1")
+				conn.rollback()
+				return conn
+		except (psycopg2.OperationalError, psycopg2.InterfaceError):
+			pass
+		log.warning("Database connection lost, reconnecting")
+		reconnects.inc()
+		_last_used.pop(id(conn), None)
+		_pool.putconn(conn, close=True)
+
+@contextlib.contextmanager
+def _cursor(name=None):
+	"""Check out a connection and open a transaction on it
+
+	Commits if the block completes, rolls back if it raises, and returns the
+	connection to the pool either way (or discards it if it has failed).
+
+	name: If given, the cursor is a server-side one, which fetches the rows
+	of a query in batches of config.db_itersize as they're iterated over,
+	rather than all at once
+	"""
+	start = time.perf_counter()
+	_pool_slots.acquire()
+	pool_wait.observe(time.perf_counter() - start)
+	pool_in_use.inc()
+	try:
+		conn = _checkout()
+		broken = False
+		try:
+			with conn, conn.cursor(name) as cur:
+				if name: cur.itersize = config.db_itersize
+				yield cur
+		except (psycopg2.OperationalError, psycopg2.InterfaceError):
+			broken = True
+			raise
+		finally:
+			if broken:
+				_last_used.pop(id(conn), None)
+				_pool.putconn(conn, close=True)
+			else:
+				_last_used[id(conn)] = time.monotonic()
+				_pool.putconn(conn)
+	finally:
+		pool_in_use.dec()
+		_pool_slots.release()
+
+def _invalidates_cache(func):
+	"""Mark a function as changing what the web server caches are built from
+
+	The cache is invalidated once the function returns (or raises), by which
+	time its transaction has been committed (or rolled back).
+	"""
+	@functools.wraps(func)
+	def wrapper(*args, **kwargs):
+		try: return func(*args, **kwargs)
+		finally: cache.invalidate()
+	return wrapper
+
 class Track(object):
+	"""One row of the tracks table
+
+	Construct with the values of Track.columns, in order, or with those of a
+	projection (see Track.projection()) and its index. Columns that weren't
+	selected read as None. The track_details and full_track_details dicts
+	are built on first use, since bulk listings mostly never look at them.
+	"""
 	# Select these from the tracks table to construct a track object.
 	columns = "id,filename,artist,title,length,status,submitter,submitteremail,submitted,lyrics,story,comments,xfade,itrim,otrim,sequence,keywords,url"
-	def __init__(self, id, filename, artist, title, length, status, 
-				submitter, submitteremail, submitted, lyrics, story, comments, xfade, itrim, otrim, sequence, keywords, url):
-		log.debug("Rendering Track(%r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r)", id, filename, artist, title,
-											length, status, story, comments, xfade, itrim, otrim)
-		if len(artist.split(',')) > 1:
-			the_artist = artist.split(',')
-			artist_exact = artist
-			artist = ' '.join([the_artist[1], the_artist[0]])
-		else:
-			artist_exact = artist
-		self.id = id
-		self.filename = filename
-		# TODO: Tighten up the purposes of these two. As of 20161219,
-		# track_details goes to the client as track status, and the
-		# other is administrative-only... I think. Maybe.
-		self.track_details = {
-			'id': id,
-			'artist': artist,
-			'artist_exact': artist_exact,
-			'title': title,
-			'length': length,
-			'status': status,
-			'story': story,
-			'lyrics': lyrics,
-			'xfade': xfade, 
-			'itrim': itrim,
-			'otrim': otrim,
-			'comments': comments,
-			'sequence': sequence,
-			'url': url,
-		}
-		self.full_track_details = {
-			'status': status,
-			'submitted': submitted,
-			'submitter': submitter,
-			'submitteremail': submitteremail,
-			'lyrics': lyrics,
-			'story': story,
-			'comments': comments,
-			'keywords': keywords,
-		}
-
-class EndOfTracks:
-	"""Marker to signal the renderer that we're done.
-
-	It's like a Track but has an ID of zero."""
-	def __init__(self):
-		self.id = 0
+	_index = {name: idx for idx, name in enumerate(columns.split(","))}
+	__slots__ = ("_row", "_fields", "_details", "_full_details")
+	def __init__(self, *row, index=None):
+		self._row = row
+		self._fields = index or Track._index
+		self._details = self._full_details = None
+
+	@staticmethod
+	def projection(*columns):
+		"""Select only some columns, for listings that don't need them all
+
+		columns: Column names, or SQL expressions ending "AS name"
+
+		Returns (column list for the SELECT, index to construct with).
+		"""
+		names = [col.split()[-1] for col in columns]
+		return ",".join(columns), {name: idx for idx, name in enumerate(names)}
+
+	def _get(self, name):
+		idx = self._fields.get(name)
+		return None if idx is None else self._row[idx]
+
+	@property
+	def id(self): return self._get("id")
+
+	@property
+	def filename(self): return self._get("filename")
+
+	# TODO: Tighten up the purposes of these two. As of 20161219,
+	# track_details goes to the client as track status, and the
+	# other is administrative-only... I think. Maybe.
+	@property
+	def track_details(self):
+		if self._details is None:
+			get = self._get
+			artist = artist_exact = get("artist")
+			if artist and len(artist.split(',')) > 1:
+				the_artist = artist.split(',')
+				artist = ' '.join([the_artist[1], the_artist[0]])
+			self._details = {
+				'id': get("id"),
+				'artist': artist,
+				'artist_exact': artist_exact,
+				'title': get("title"),
+				'length': get("length"),
+				'status': get("status"),
+				'story': get("story"),
+				'lyrics': get("lyrics"),
+				'xfade': get("xfade"),
+				'itrim': get("itrim"),
+				'otrim': get("otrim"),
+				'comments': get("comments"),
+				'sequence': get("sequence"),
+				'url': get("url"),
+			}
+		return self._details
+
+	@property
+	def full_track_details(self):
+		if self._full_details is None:
+			get = self._get
+			self._full_details = {
+				'status': get("status"),
+				'submitted': get("submitted"),
+				'submitter': get("submitter"),
+				'submitteremail': get("submitteremail"),
+				'lyrics': get("lyrics"),
+				'story': get("story"),
+				'comments': get("comments"),
+				'keywords': get("keywords"),
+			}
+		return self._full_details
 
 class Submitter(object):
     def __init__(self,username,email,userid,artist,track_id,filename,lyrics,story):
@@ -88,6 +203,19 @@ class Submitter(object):
         }
 
 DUMMY_PASSWORD = "5fe87280b1cabccf6b973934ca03ee4e-cf43009757937c46f198b6ad831a0420c78e9b074141b372742cf62755d1866e"
+# Every request from a logged-in user looks them up, so remember them for a
+# while (least recently used first out). The functions here that change
+# accounts forget them again, but only in this process; other processes may
+# keep using their copies for up to config.user_cache_ttl seconds.
+_user_cache = collections.OrderedDict() # id: (time.monotonic() when loaded, User)
+_user_cache_lock = threading.Lock()
+user_cache_lookups = metrics.Counter("glitch_user_cache_lookups_total", "User lookups, by whether they were cached", ["result"])
+
+def _forget_user(id):
+	"""Drop a user from the cache; call after changing their account"""
+	with _user_cache_lock:
+		_user_cache.pop(int(id), None)
+
 class User(UserMixin):
 	def __init__(self, id, username, email, status, user_level):
 		self.id = id
@@ -98,15 +226,29 @@ class User(UserMixin):
 
 	@classmethod
 	def from_id(cls, id, password=None):
-		with _conn, _conn.cursor() as cur:
+		id = int(id) # Some callers pass it straight from the URL
+		now = time.monotonic()
+		with _user_cache_lock:
+			cached = _user_cache.get(id)
+			if cached and now - cached[0] < config.user_cache_ttl:
+				_user_cache.move_to_end(id)
+				user_cache_lookups.labels("hit").inc()
+				return cached[1]
+		user_cache_lookups.labels("miss").inc()
+		with _cursor() as cur:
 			cur.execute("select id, username, email, status, user_level from users where id=%s", (id,))
 			data = cur.fetchone()
 		if not data: return None
-		return cls(*data)
+		user = cls(*data)
+		with _user_cache_lock:
+			_user_cache[id] = (now, user)
+			_user_cache.move_to_end(id)
+			while len(_user_cache) > config.user_cache_size: _user_cache.popitem(last=False)
+		return user
 
 	@classmethod
 	def from_credentials(cls, login, password):
-		with _conn, _conn.cursor() as cur:
+		with _cursor() as cur:
 			cur.execute("select id, username, email, status, user_level, password from users where email=%s or username=%s", (login, login))
 			data = cur.fetchone()
 		if not utils.check_password(data[-1] if data else DUMMY_PASSWORD, password):
@@ -131,12 +273,23 @@ class Artist(object):
 			'name_list': name_list
 		}
 
+_strip_punctuation = {ord(char): None for char in string.punctuation}
+
+def count_words(couplets):
+	"""Count the words in some couplets, as the word cloud reckons them"""
+	return collections.Counter(word for couplet in couplets
+		for word in couplet.translate(_strip_punctuation).split())
+
+def split_couplets(lyrics):
+	"""Find the couplets in some lyrics: the stanzas of exactly two lines"""
+	return [block for block in re.split(r'(?:\r\n){2,}', lyrics) if block.count('\r\n') == 1]
+
 class Lyric(object):
 	# Select these from the tracks table to construct a track object.
 	columns = "id,artist,lyrics"
 	
 	def __init__(self, id, artist, lyrics):
-		couplets = [block for block in re.split(r'(?:\r\n){2,}', lyrics) if block.count('\r\n') == 1]
+		couplets = split_couplets(lyrics)
 		couplet_count = len(couplets)
 		lyrics = self.get_couplets(lyrics)
 		an_artist = Artist(artist)
@@ -153,97 +306,157 @@ class Lyric(object):
 	def get_couplets(self, lyrics):
 		return lyrics.splitlines(True)
 
-def get_many_mp3(status=1, order_by='length'):
+def get_many_mp3(status=1, order_by='length', columns=None):
 	"""Get a list of many (possibly all) the tracks in the database.
 
 	Returns a list, guaranteed to be fully realized prior to finishing
 	with the database cursor, for safety.
+
+	columns: If given, select only these (see Track.projection()); anything
+	else reads as None
 	"""
-	query = "SELECT {cols} FROM tracks WHERE {col}=%s ORDER BY {ord}""".format(cols=Track.columns, col=("'all'" if status=='all' else 'status'), ord=order_by)
-	with _conn, _conn.cursor() as cur:
+	cols, index = Track.projection(*columns) if columns else (Track.columns, None)
+	query = "SELECT {cols} FROM tracks WHERE {col}=%s ORDER BY {ord}""".format(cols=cols, col=("'all'" if status=='all' else 'status'), ord=order_by)
+	with _cursor("get_many_mp3") as cur:
 		cur.execute(query, (status,))
-		return [Track(*row) for row in cur.fetchall()]
+		return [Track(*row, index=index) for row in cur]
 
-_track_queue = queue.Queue()
-		
-def get_track_to_play():
-	"""Get a track from the database with presumption that it will be played.
+# Take the oldest outstanding request off the queue, in one round trip. This
+# is how the renderer finds out what listeners want to hear (see prefetch.py).
+# The request is returned even if its track has since been deleted or
+# deactivated (with NULLs for the track), so that it's still used up.
+CLAIM_REQUEST = ("WITH req AS (UPDATE queue SET played=now() WHERE id=(SELECT id FROM queue WHERE played IS NULL "
+	"ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING track_id) "
+	"SELECT req.track_id, "+Track.columns+" FROM req LEFT JOIN tracks ON tracks.id=req.track_id AND tracks.status=1")
 
-	If something has been enqueued with enqueue_track(), that will be the one
-	returned; otherwise, one is picked by magic.
+def enqueue_track(id, userid=0):
+	"""Ask the renderer to play a track as soon as possible
 
-	TODO: Prefer tracks that haven't been played *recently*. Currently, any
-	track added after the system's been up for a while will be played to death.
+	Returns None on success, or an error message if the request isn't allowed.
 	"""
-	with _conn, _conn.cursor() as cur:
-		try:
-			track=_track_queue.get(False)
-			log.info("Using enqueued track %s.", track.id)
-		except queue.Empty:
-			cur.execute("SELECT "+Track.columns+" FROM tracks WHERE status=1 ORDER BY played,random()")
-			row=cur.fetchone()
-			if not row: raise ValueError("Database is empty, cannot enqueue track") from None
-			track=Track(*row)
-			log.info("Automatically picking track %s.", track.id)
-		# Record that a track has been played.
-		# Currently simply increments the counter; may later keep track of how long since played, etc.
-		cur.execute("UPDATE tracks SET played=played+1 WHERE id=%s", (track.id,))
-		return track
-
-def enqueue_track(id):
-	with _conn, _conn.cursor() as cur:
-		cur.execute("UPDATE tracks SET enqueued=enqueued+1 WHERE ID=%s RETURNING "+Track.columns, (id,))
-		# Assumes the ID is actually valid (will raise TypeError if not)
-		_track_queue.put(Track(*cur.fetchone()))
-
-def enqueue_all_tracks():
-	"""Enqueue every active track in a random order, followed by an end marker."""
-	with _conn, _conn.cursor() as cur:
-		cur.execute("SELECT "+Track.columns+" FROM tracks WHERE status=1 ORDER BY sequence,random()")
-		for track in cur:
-			_track_queue.put(Track(*track))
-	_track_queue.put(EndOfTracks())
+	with _cursor() as cur:
+		cur.execute("SELECT 1 FROM tracks WHERE id=%s AND status=1", (id,))
+		if not cur.fetchone(): return "That track isn't available."
+		if userid:
+			cur.execute("SELECT count(*) FROM queue WHERE userid=%s AND requested > now() - %s * interval '1 second'",
+				(userid, config.enqueue_user_window))
+			if cur.fetchone()[0] >= config.enqueue_user_limit:
+				return "You've requested a lot of tracks lately. Give the others a turn!"
+		# Don't let any track be requested over and over: count the requests
+		# for it that are still waiting, or that were played recently.
+		cur.execute("SELECT count(*) FROM queue WHERE track_id=%s AND (played IS NULL OR played > now() - %s * interval '1 second')",
+			(id, config.enqueue_track_window))
+		if cur.fetchone()[0] >= config.enqueue_track_limit:
+			return "That track has been requested a lot lately. Try another!"
+		cur.execute("UPDATE tracks SET enqueued=enqueued+1 WHERE id=%s", (id,))
+		cur.execute("INSERT INTO queue (track_id, userid) VALUES (%s, %s)", (id, userid))
+		# Wake the renderer (delivered when this transaction commits).
+		cur.execute("NOTIFY track_queue")
 
 def get_single_track(track_id):
 	"""Get details for a single track by its ID"""
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		cur.execute("SELECT "+Track.columns+" FROM tracks WHERE id=%s", (track_id,))
 		return Track(*cur.fetchone())
 
 def get_complete_length():
 	"""Get the sum of length of all active tracks."""
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		cur.execute("SELECT coalesce(sum(length),0) FROM tracks WHERE status = 1")
 		return cur.fetchone()[0]
 		
 def get_all_lyrics():
 	"""Get the lyrics from all active tracks.."""
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		cur.execute("SELECT id, artist, lyrics FROM tracks WHERE status = 1 AND lyrics != ''")
 		return [Lyric(*row) for row in cur.fetchall()]
 		
-def match_lyrics(word):
-	with _conn, _conn.cursor() as cur:
-		cur.execute("SELECT id, artist, lyrics FROM tracks WHERE lyrics ILIKE %s", ('%'+word+'%',))
-		return [Lyric(*row) for row in cur.fetchall()]
-		
-def match_keywords(word):
-	with _conn, _conn.cursor() as cur:
-		cur.execute("SELECT id, artist, lyrics FROM tracks WHERE keywords ILIKE %s", ('%'+word+'%',))
-		return [Lyric(*row) for row in cur.fetchall()]
+def get_popular_words(count):
+	"""Get the most common words in active tracks' couplets, as (word, count) pairs"""
+	with _cursor() as cur:
+		cur.execute("SELECT word, count FROM wordcounts ORDER BY count DESC LIMIT %s", (count,))
+		return cur.fetchall()
+
+def index_track(cur, id):
+	"""Bring the Oracle's couplet index and word counts up to date with one track
+
+	Call with the cursor that changed the track's lyrics, keywords or status,
+	so that they all change together.
+	"""
+	# Take the track's old couplets out of the counts, and its new ones in.
+	cur.execute("DELETE FROM couplets WHERE track_id=%s RETURNING couplet, counted", (id,))
+	counts = collections.Counter()
+	counts.subtract(count_words(couplet for couplet, counted in cur.fetchall() if counted))
+	cur.execute("SELECT lyrics, keywords, status FROM tracks WHERE id=%s", (id,))
+	row = cur.fetchone()
+	if row:
+		lyrics, keywords, status = row
+		couplets = split_couplets(lyrics)
+		for couplet in couplets:
+			cur.execute("""INSERT INTO couplets (track_id, couplet, words, keywords, counted)
+				VALUES (%s, %s, to_tsvector('simple', %s), to_tsvector('simple', %s), %s)""",
+				(id, couplet, couplet, keywords, status == 1))
+		if status == 1: counts.update(count_words(couplets))
+	# In a consistent order, so that concurrent updates lock the rows they
+	# share in the same order rather than deadlocking.
+	changes = sorted((word, count) for word, count in counts.items() if count)
+	if not changes: return
+	cur.execute("""INSERT INTO wordcounts (word, count) SELECT * FROM unnest(%s::varchar[], %s::int[])
+		ON CONFLICT (word) DO UPDATE SET count=wordcounts.count+excluded.count""",
+		([word for word, count in changes], [count for word, count in changes]))
+	cur.execute("DELETE FROM wordcounts WHERE count<=0")
+
+@cmdline
+def reindex_couplets():
+	"""Rebuild the Oracle's couplet index and word counts for every track"""
+	with _cursor() as cur:
+		cur.execute("TRUNCATE couplets, wordcounts")
+		cur.execute("SELECT id FROM tracks")
+		for id, in cur.fetchall():
+			index_track(cur, id)
+
+def match_couplet(words):
+	"""Find a couplet for the Oracle to answer with
+
+	words: Words from the question; a couplet matches if it contains a word
+	starting with any of them, or if its track's keywords do
+
+	Returns (artist, couplet), preferring keyword matches and otherwise
+	picked at random, or None if nothing matches.
+	"""
+	# The question has had its punctuation turned into underscores, so
+	# "don't" arrives as "don_t". Fragments like that "t" would match (as
+	# prefixes) nearly everything, so only proper words are looked for.
+	terms = {term for word in words for term in re.split(r"[\W_]+", word) if len(term) >= 3}
+	if not terms: return None
+	query = " | ".join(term + ":*" for term in terms)
+	with _cursor() as cur:
+		cur.execute("""SELECT artist, couplet FROM couplets JOIN tracks ON tracks.id=couplets.track_id,
+				to_tsquery('simple', %s) AS query
+			WHERE couplets.keywords @@ query OR words @@ query
+			ORDER BY couplets.keywords @@ query DESC, random() LIMIT 1""", (query,))
+		return cur.fetchone()
 		
 def random_lyrics():
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		cur.execute("SELECT id, artist, lyrics FROM tracks WHERE lyrics != '' ORDER BY random() limit 1")
 		return [Lyric(*row) for row in cur.fetchall()]
 
-def get_track_artwork(id):
-	"""Get the artwork for one track, or None if no track, or '' if no artwork."""
-	with _conn, _conn.cursor() as cur:
-		cur.execute("SELECT artwork FROM tracks WHERE id=%s", (id,))
-		row = cur.fetchone()
-		return row and row[0]
+def get_track_artwork(id, unless=()):
+	"""Get the artwork for one track, as (MD5 hex digest, data)
 
+	unless: Digests the caller already has the data for; if it matches one,
+	the data comes back as None
+
+	Returns None if no track, or ('', None) if it has no artwork.
+	"""
+	with _cursor() as cur:
+		cur.execute("""SELECT CASE WHEN artwork='' THEN '' ELSE md5(artwork) END,
+			CASE WHEN artwork='' OR md5(artwork)=ANY(%s::varchar[]) THEN NULL ELSE artwork END
+			FROM tracks WHERE id=%s""", (list(unless), id))
+		return cur.fetchone()
+
+@_invalidates_cache
 def create_track(mp3data, filename, info, image=None, username=None):
 	"""Save a blob of MP3 data to the specified file and registers it in the database.
 
@@ -260,10 +473,10 @@ def create_track(mp3data, filename, info, image=None, username=None):
 	if not mp3data.startswith(b"ID3") and not mp3data.startswith(b"\xFF\xFB"):
 		raise ValueError("Not MP3 data")
 	if not username:
-	    with _conn, _conn.cursor() as cur:
+	    with _cursor() as cur:
 	        cur.execute("SELECT username FROM users WHERE user_level = 2 LIMIT 1;")
 	        username = cur.fetchone()[0] 
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		# We have a chicken-and-egg problem here. We can't (AFAIK) get the ID3 data
 		# until we have a file, and we want to name the file based on the track ID.
 		# Resolution: Either save the file to a temporary name and then rename it,
@@ -297,18 +510,22 @@ def create_track(mp3data, filename, info, image=None, username=None):
 			track.info.length,
 			id)
 		)
+		index_track(cur, id)
 		return id
 
+@_invalidates_cache
 def delete_track(id):
 	"""Delete the given track ID - no confirmation"""
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		cur.execute("DELETE FROM tracks WHERE id = %s", (id,))
+		index_track(cur, id)
 		
 def reset_played():
     """Reset played for all tracks to 0"""
-    with _conn, _conn.cursor() as cur:
+    with _cursor() as cur:
         cur.execute("UPDATE tracks SET played = 0")
 
+@_invalidates_cache
 def update_track(id, info, artwork=None):
 	"""Update the given track ID based on the info mapping.
 
@@ -318,7 +535,7 @@ def update_track(id, info, artwork=None):
 	"""
 	print('****************')
 	log.info(info)
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		# Enumerate all updateable fields. If they're not provided, they won't be updated;
 		# any other fields will be ignored. This is basically set intersection on a dict.
 		fields = ("artist", "status", "lyrics", "story", "keywords", "url", "sequence")
@@ -330,15 +547,17 @@ def update_track(id, info, artwork=None):
 		# being picked up by the generic field handler above.
 		if artwork is not None: param['artwork'] = memoryview(artwork)
 		cur.execute("UPDATE tracks SET "+",".join(x+"=%("+x+")s" for x in param)+" WHERE id="+str(id),param)
+		if {"lyrics", "keywords", "status"} & set(param): index_track(cur, id)
 		
+@_invalidates_cache
 def sequence_tracks(sequence_object):
 	for id, sequence in sequence_object.items():
 		seq = sequence_object.get(id,'')[0]
-		with _conn, _conn.cursor() as cur:
+		with _cursor() as cur:
 			cur.execute("UPDATE tracks SET sequence = "+str(seq)+", played = 0 WHERE id="+str(id))
 	
 def get_track_submitter_info():
-    with _conn, _conn.cursor() as cur:
+    with _cursor() as cur:
         query = '''SELECT a.username, a.email, a.id as userid, b.artist, b.id as track_id, b.filename,
                 CASE WHEN b.lyrics !='' THEN 1
                 ELSE 0
@@ -359,12 +578,13 @@ def update_track_submitter_info(submitter_object):
         name = track_grouping[2]
         email = track_grouping[3]
         track_id = track_grouping[0]
-        with _conn, _conn.cursor() as cur:
+        with _cursor() as cur:
             cur.execute("UPDATE users SET username = '"+str(name)+"', email = '"+str(email)+"' WHERE id = "+str(userid))
+        _forget_user(userid)
 
 def add_dummy_users():
     start_default_email_number = 0
-    with _conn, _conn.cursor() as cur:
+    with _cursor() as cur:
         cur.execute("SELECT artist FROM tracks WHERE userid = 0 GROUP BY artist;")
         artists = cur.fetchall()
         for artist in artists:
@@ -378,7 +598,7 @@ def add_dummy_users():
         
 
 def create_outreach_message(message):
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		cur.execute("INSERT INTO outreach (message) VALUES (%s) RETURNING id, message", (message,))
 		return [row for row in cur.fetchone()]
 											
@@ -387,7 +607,7 @@ def update_outreach_message(message):
         return create_outreach_message(message)
     query = "UPDATE outreach SET message = (message) WHERE id = 1 RETURNING id, message"
     data = (message,)
-    with _conn, _conn.cursor() as cur:
+    with _cursor() as cur:
         cur.execute(query, data)
         return [row for row in cur.fetchone()]
 
@@ -397,7 +617,7 @@ def retrieve_outreach_message():
 	# comment when all usage has been migrated.
 	# If this is supposed to return the most recent, it should possibly be using
 	# ORDER BY ID DESC.
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		cur.execute("SELECT id, message FROM outreach ORDER BY id LIMIT 1")
 		try:
 			return cur.fetchone()[0]
@@ -406,7 +626,7 @@ def retrieve_outreach_message():
 
 def get_track_filename(track_id):
     """Return filename for a specific track, or None"""
-    with _conn, _conn.cursor() as cur:
+    with _cursor() as cur:
         cur.execute("SELECT filename FROM tracks WHERE id = %s", (track_id,))
         for row in cur: return row[0]
 
@@ -415,20 +635,20 @@ def browse_tracks(letter):
 	query = """SELECT DISTINCT artist FROM tracks WHERE status = 1 AND
 		(case when artist ilike 'The %' then substr(upper(artist), 5, 100) else upper(artist) end) >= '{letter}'
 		ORDER BY artist LIMIT 20""".format(cols=Track.columns, letter=letter)
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		cur.execute(query)
 		return [row for row in cur.fetchall()]
 
 def get_recent_tracks(number):
         """Retrieve [number] number of most recently activated tracks"""
         query = "SELECT DISTINCT artist, submitted FROM tracks WHERE status = 1 ORDER BY submitted DESC LIMIT {number}".format(cols=Track.columns, number=number)
-        with _conn, _conn.cursor() as cur:
+        with _cursor() as cur:
                 cur.execute(query)
                 return [row for row in cur.fetchall()]
         
 def tracks_by(artist):
     """Return artist, id for tracks, where artist name starts with letter in expression"""
-    with _conn, _conn.cursor() as cur:
+    with _cursor() as cur:
         cur.execute("SELECT {cols} FROM tracks WHERE status = 1 AND trim(artist) = '{artist}' ORDER BY title LIMIT 20".format(cols=Track.columns, artist=artist))
         return [Track(*row) for row in cur.fetchall()]
 
@@ -445,7 +665,7 @@ def create_user(username, email, password):
 	username = username.lower(); email = email.lower();
 	if not isinstance(password, bytes): password=password.encode("utf-8")
 	hex_key = utils.random_hex()
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		pwd = utils.hash_password(password)
 		try:
 			cur.execute("INSERT INTO users (username, email, password, hex_key) VALUES (%s, %s, %s, %s) RETURNING id, hex_key", \
@@ -463,15 +683,14 @@ def confirm_user(id, hex_key):
 
     hex_key: Matching key to the one stored, else the confirmation fails
     """
-    with _conn, _conn.cursor() as cur:
+    with _cursor() as cur:
         cur.execute("UPDATE users SET status = 1, hex_key = '' WHERE id = %s AND hex_key = %s RETURNING username", (id, hex_key))
-        try:
-                return cur.fetchone()[0]
-        except TypeError:
-                return None
+        row = cur.fetchone()
+    _forget_user(id)
+    return row and row[0]
                 
 def test_reset_permissions(id, hex_key):
-    with _conn, _conn.cursor() as cur:
+    with _cursor() as cur:
         cur.execute("SELECT id, username, email FROM users WHERE id = %s AND hex_key = %s", (id, hex_key))
         try:
                 return cur.fetchone()
@@ -488,17 +707,18 @@ def set_user_password(user_or_email, password):
 	"""
 	user_or_email = user_or_email.lower()
 	if not isinstance(password, bytes): password=password.encode("utf-8")
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		pwd = utils.hash_password(password)
 		cur.execute("SELECT id FROM users WHERE username=%s OR email=%s AND status=1", (user_or_email, user_or_email))
 		rows=cur.fetchall()
 		if len(rows)!=1: return "There is already an account for that email."
 		cur.execute("update users set password=%s where id=%s", (pwd, rows[0][0]))
+	_forget_user(rows[0][0])
 		
 def check_db_for_user(user_or_email):
 	"""Change a user's password (administratively) - returns None on success, or error message"""
 	user_or_email = user_or_email.lower()
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		cur.execute("SELECT id, status FROM users WHERE username=%s OR email=%s", (user_or_email, user_or_email))
 		rows=cur.fetchall()
 		print(rows)
@@ -509,7 +729,7 @@ def verify_user(user_or_email, password):
 	"""Verify a user name/email and password, returns the ID if valid or None if not"""
 	user_or_email = user_or_email.lower()
 	if not isinstance(password, bytes): password=password.encode("utf-8")
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		cur.execute("SELECT id,password FROM users WHERE username=%s OR email=%s AND status=1", (user_or_email, user_or_email))
 		for id, pwd in cur:
 			if utils.check_password(pwd, password):
@@ -518,7 +738,7 @@ def verify_user(user_or_email, password):
 
 def get_user_info(id):
 	"""Return the user name and permissions level for a given UID, or (None,0) if not logged in"""
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		cur.execute("SELECT username, user_level FROM users WHERE id=%s", (id,))
 		row = cur.fetchone()
 		return row or (None, 0)
@@ -526,23 +746,24 @@ def get_user_info(id):
 def request_password_reset(email):
 	"""Returns id and hex_key if a match, else None on error"""
 	hex_key = utils.random_hex()
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		cur.execute("UPDATE users set hex_key = %s WHERE email=%s RETURNING id, hex_key", (hex_key, email))
 		return cur.fetchone()
 
 def reset_user_password(id, hex_key, password):
 	if not isinstance(password, bytes): password=password.encode("utf-8")
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		pwd = utils.hash_password(password)
 		cur.execute("update users set password=%s, hex_key='' where id=%s and hex_key=%s", (pwd, id, hex_key))
+	_forget_user(id)
 
 def get_analysis(id):
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		cur.execute("select analysis from tracks where id=%s", (id,))
 		return cur.fetchone()[0]
 
 def save_analysis(id, analysis):
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		cur.execute("update tracks set analysis=%s where id=%s", (analysis, id))
 
 @cmdline
@@ -565,6 +786,7 @@ def importmp3(*filename, submitter="Bulk import", submitteremail="bulk@import.in
 		print("Saved as track #%d."%id)
 
 @cmdline
+@_invalidates_cache
 def transfer_track_details(from_id=0, to_id=0):
 	"""Transfer details of track from one track to another
 
@@ -572,7 +794,7 @@ def transfer_track_details(from_id=0, to_id=0):
 
 	to_id: Track id to transfer data to.
 	"""
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		if not from_id:
 			print("Add two track ids to transfer details. Here are some likely candidates:")
 			query = """SELECT artist, id, filename FROM tracks ou
@@ -593,6 +815,7 @@ def transfer_track_details(from_id=0, to_id=0):
 			cur.execute(query)
 			for line in cur.fetchall():
 				print(line, "Has been updated")
+				index_track(cur, line[0])
 
 @cmdline
 def tables(*, confirm=False):
@@ -601,7 +824,7 @@ def tables(*, confirm=False):
 	confirm: If omitted, will do a dry run.
 	"""
 	tb = None; cols = set(); coldefs = []
-	with _conn, _conn.cursor() as cur:
+	with _cursor() as cur:
 		def finish():
 			if tb and (coldefs or cols):
 				if is_new: query = "create table "+tb+" ("+", ".join(coldefs)+")"
@@ -613,7 +836,13 @@ def tables(*, confirm=False):
 		for line in open("create_table.sql"):
 			line = line.rstrip()
 			if line == "" or line.startswith("--"): continue
-			# Flush-left lines are table names
+			# Flush-left lines are table names, or statements to run as they are
+			if line.startswith("create "):
+				finish()
+				tb = None
+				if confirm: cur.execute(line)
+				else: print(line)
+				continue
 			if line == line.lstrip():
 				finish()
 				tb = line; cols = set(); coldefs = []
@@ -0,0 +1,144 @@
+"""HTTP Live Streaming output for the renderer
+
+As an alternative to having the renderer itself send the stream to every
+listener, one of the encoded streams can be cut into segment files with a
+rolling .m3u8 playlist, and the whole lot served by anything that can serve
+static files (and cached by anything that can cache them).
+
+Segments are packed MP3 audio, each starting with the ID3 timestamp that HLS
+requires. They are cut every config.hls_segment_time seconds, and also at the
+start of every track, so each track begins on a segment boundary. Every
+segment has an EXT-X-PROGRAM-DATE-TIME, which is the same clock as the
+start_time values in /status.json, so clients can tell what's playing.
+"""
+import os
+import math
+import time
+import logging
+import collections
+from . import config
+
+log = logging.getLogger(__name__)
+
+PLAYLIST = "live.m3u8"
+
+def _syncsafe(n):
+	return bytes((n >> shift) & 0x7F for shift in (21, 14, 7, 0))
+
+def timestamp_tag(position):
+	"""Build the ID3 tag that gives a packed audio segment its timestamp
+
+	position: Stream position of the segment's first frame (seconds)
+	"""
+	# The timestamp is on the 90KHz MPEG-2 clock, in 33 bits.
+	ts = int(position * 90000) & (2**33 - 1)
+	data = b"com.apple.streaming.transportStreamTimestamp\0" + ts.to_bytes(8, "big")
+	frame = b"PRIV" + _syncsafe(len(data)) + b"\0\0" + data
+	return b"ID3\4\0\0" + _syncsafe(len(frame)) + frame
+
+def _write_atomic(fn, data):
+	# Write to a temporary name and then rename, so that nothing serving
+	# the directory ever sees a partial file.
+	tmp = fn + ".tmp"
+	with open(tmp, "wb") as f: f.write(data)
+	os.replace(tmp, fn)
+
+class Segmenter(object):
+	"""Cut a stream into HLS segments as it is encoded
+
+	stream: broadcast.Stream to segment (must be MP3)
+
+	timeline: broadcast.Timeline shared with the stream
+
+	directory: Where to write the playlist and segments
+
+	segment_time: Target duration of a segment (seconds)
+
+	list_size: Number of segments in the playlist
+	"""
+	def __init__(self, stream, timeline, directory=config.hls_dir,
+			segment_time=config.hls_segment_time, list_size=config.hls_list_size):
+		if stream.format != "mp3": raise ValueError("HLS output needs an MP3 stream")
+		self.stream = stream
+		self.timeline = timeline
+		self.directory = directory
+		self.segment_time = segment_time
+		self.list_size = list_size
+		self.cuts = collections.deque() # Stream positions where tracks start
+		self.segments = collections.deque() # (sequence, duration, wall time, discontinuity)
+		self.sequence = 0 # Media sequence number of the next segment
+
+	def cut_at(self, position):
+		"""Ensure that a segment begins at this stream position (seconds)"""
+		self.cuts.append(position)
+
+	def _next_cut(self, start):
+		while self.cuts and self.cuts[0] <= start: self.cuts.popleft()
+		end = start + self.segment_time
+		if self.cuts: end = min(end, self.cuts[0])
+		return end
+
+	def _finish(self, data, start, end, discontinuity):
+		seq = self.sequence; self.sequence += 1
+		_write_atomic(os.path.join(self.directory, "%d.mp3" % seq), timestamp_tag(start) + data)
+		self.segments.append((seq, end - start, self.timeline.wall_time(start), discontinuity))
+		# Keep some segments past the end of the playlist, as a client
+		# may have just fetched the previous version of it.
+		while len(self.segments) > self.list_size:
+			old = self.segments.popleft()[0] - self.list_size
+			if old < 0: continue
+			try: os.unlink(os.path.join(self.directory, "%d.mp3" % old))
+			except FileNotFoundError: pass
+		self._write_playlist()
+
+	def _write_playlist(self):
+		target = math.ceil(max(duration for seq, duration, wall, disc in self.segments))
+		lines = [
+			"#EXTM3U",
+			"#EXT-X-VERSION:3",
+			"#EXT-X-TARGETDURATION:%d" % target,
+			"#EXT-X-MEDIA-SEQUENCE:%d" % self.segments[0][0],
+		]
+		for seq, duration, wall, disc in self.segments:
+			if disc: lines.append("#EXT-X-DISCONTINUITY")
+			lines.append("#EXT-X-PROGRAM-DATE-TIME:%s.%03dZ" % (
+				time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(wall)), int(wall * 1000) % 1000))
+			lines.append("#EXTINF:%.3f," % duration)
+			lines.append("%d.mp3" % seq)
+		_write_atomic(os.path.join(self.directory, PLAYLIST), ("\n".join(lines) + "\n").encode("ascii"))
+
+	async def run(self):
+		"""Segment the stream as it arrives. Doesn't return."""
+		os.makedirs(self.directory, exist_ok=True)
+		ring = self.stream.ring
+		await ring.wait_for(ring.first_seq)
+		seq, offset = ring.first_seq, 0
+		data = bytearray()
+		start = ring.position(seq, offset)
+		end = self._next_cut(start)
+		discontinuity = False
+		while True:
+			await ring.wait_for(seq)
+			if seq < ring.first_seq:
+				# We've been starved for so long that the ring buffer
+				# has overwritten what was to come next. Shouldn't
+				# happen, but if it does, pick up the thread again.
+				log.warning("HLS segmenter fell behind, skipping from chunk %d", seq)
+				seq, offset = ring.first_seq, 0
+				data = bytearray()
+				start = ring.position(seq, offset)
+				end = self._next_cut(start)
+				discontinuity = True
+			length = len(ring.get(seq))
+			chunk, offset = ring.read(seq, offset, end)
+			data += chunk
+			if offset >= length:
+				seq += 1; offset = 0
+				continue
+			# The next frame belongs in a new segment.
+			position = ring.position(seq, offset)
+			self._finish(bytes(data), start, position, discontinuity)
+			data = bytearray()
+			start = position
+			end = self._next_cut(start)
+			discontinuity = False
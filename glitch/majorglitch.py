@@ -0,0 +1,147 @@
+"""Batch rendering of the Major Glitch
+
+The Major Glitch is every active track, in sequence, mixed together into one
+file. Unlike the live renderer there's no need to go at real-time speed, so
+the work is spread across a process pool in three stages:
+
+1) Decode and analyse every track (as the live renderer's prefetcher does).
+2) Work out every transition. This needs only the analyses, and tells us how
+   much of each track the previous transition has already played.
+3) Mix the segments - each one a track up to and including its transition
+   into the next - and feed them, in order, into the encoder.
+
+The segments are exactly the buffers that the live renderer would produce for
+the same tracks, so the result is sample-for-sample the same. They all go to
+a single encoder, since MP3s encoded separately and then joined would have
+the encoder's padding at every join.
+
+Mixed segments are kept in config.segment_cache_dir, named for everything
+that goes into them: both tracks' audio files, the transition, and the mixer
+VERSION. Reordering or changing a track thus only remixes the segments that
+actually involve it (usually two); the rest are spliced back in as they are.
+Segments that aren't part of the latest render are discarded.
+"""
+import os
+import shutil
+import hashlib
+import logging
+import subprocess
+import concurrent.futures
+from . import config, database, analysis, pcmcache, mixer, utils
+
+log = logging.getLogger(__name__)
+
+def _analyse(filename, source):
+	"""Analyse a track. Runs in a worker process."""
+	return analysis.dump(analysis.analyse("audio/" + filename), source)
+
+def segment_key(track1, track2, skip, bounds):
+	"""Identify a segment by everything that affects its content
+
+	track1, track2, skip, bounds: As for _render_segment(), except that the
+	tracks are (id, filename, signature)
+	"""
+	key = repr((mixer.VERSION, track1, track2, skip, bounds))
+	return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+def _render_segment(fn, track1, track2, skip, bounds):
+	"""Mix one segment to a PCM file, unless it's already cached. Runs in a
+	worker process.
+
+	fn: File to write to
+
+	track1, track2: (id, filename) for this track and the next (or None if
+	this is the last track)
+
+	skip: Amount of track1 (ms) already played by the previous transition
+
+	bounds: mixer.boundaries() for the transition, if any
+
+	Returns True if the segment had to be mixed, False if it was cached.
+	"""
+	try:
+		os.utime(fn)
+		return False
+	except FileNotFoundError:
+		pass
+	pcm1 = mixer.PCM(pcmcache.open_pcm(pcmcache.decode(*track1)))
+	tmp = "%s.%d.tmp" % (fn, os.getpid())
+	with open(tmp, "wb") as f:
+		if track2 is None:
+			f.write(pcm1.slice(skip))
+		else:
+			pcm2 = mixer.PCM(pcmcache.open_pcm(pcmcache.decode(*track2)))
+			bulk, olay1, olay2, skip = mixer.transition(pcm1, pcm2, skip, *bounds)
+			f.write(bulk); f.write(olay1); f.write(olay2)
+	os.replace(tmp, fn)
+	return True
+
+def prune(keep):
+	"""Remove every cached segment not named in keep"""
+	for entry in os.scandir(config.segment_cache_dir):
+		if entry.path in keep: continue
+		log.debug("Dropping %s from the segment cache", entry.path)
+		try: os.unlink(entry.path)
+		except FileNotFoundError: pass
+
+def render(output="major_glitch.mp3", workers=config.major_glitch_workers):
+	"""Render every active track into the Major Glitch
+
+	output: File to (atomically) replace with the result
+
+	workers: Number of processes, or None for one per CPU
+
+	Returns (reused, rebuilt) segment counts.
+	"""
+	tracks = database.get_many_mp3(status=1, order_by="sequence,random()", columns=("id", "filename"))
+	if not tracks: raise ValueError("Database is empty, cannot render")
+	log.info("Rendering %d tracks", len(tracks))
+	os.makedirs(config.segment_cache_dir, exist_ok=True)
+	with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+		# Stage 1: analyse whatever doesn't have a current analysis. Tracks
+		# are decoded only when (and if) a segment using them is remixed.
+		sources = [utils.file_signature("audio/" + track.filename) for track in tracks]
+		analyses = [analysis.load(database.get_analysis(track.id), source) for track, source in zip(tracks, sources)]
+		stale = [idx for idx, result in enumerate(analyses) if result is None]
+		log.info("Analysing %d tracks", len(stale))
+		for idx, data in zip(stale, pool.map(_analyse, [tracks[idx].filename for idx in stale], [sources[idx] for idx in stale])):
+			database.save_analysis(tracks[idx].id, data)
+			analyses[idx] = analysis.load(data, sources[idx])
+		log.info("Tracks prepared; computing transitions")
+		# Stage 2: transitions. Each one determines the next track's skip.
+		skips = [0.0]
+		bounds = []
+		for t1, t2 in zip(analyses, analyses[1:]):
+			t1_end, t2_start, t1_length = mixer.boundaries(t1, t2)
+			bounds.append((t1_end, t2_start, t1_length))
+			skips.append(t2_start + t1_length - t1_end)
+		bounds.append(None)
+		ids = [(t.id, t.filename) for t in tracks]
+		nexts = ids[1:] + [None]
+		signed = [(t.id, t.filename, source) for t, source in zip(tracks, sources)]
+		keys = map(segment_key, signed, signed[1:] + [None], skips, bounds)
+		files = [os.path.join(config.segment_cache_dir, key + ".pcm") for key in keys]
+		# Stage 3: mix in parallel, encode in order. Keep only a few
+		# segments in flight, since each is tens of megabytes of PCM.
+		window = 2 * (workers or os.cpu_count() or 1)
+		rebuilt = 0
+		encoder = subprocess.Popen(["ffmpeg", "-v", "error", "-y",
+			"-ac", str(pcmcache.CHANNELS), "-ar", str(pcmcache.FRAME_RATE), "-f", "s16le", "-i", "-",
+			"-f", "mp3", "next_glitch.mp3"], stdin=subprocess.PIPE)
+		try:
+			pending = []
+			for idx in range(len(tracks)):
+				while len(pending) < window and len(pending) + idx < len(tracks):
+					n = idx + len(pending)
+					pending.append(pool.submit(_render_segment, files[n], ids[n], nexts[n], skips[n], bounds[n]))
+				if pending.pop(0).result(): rebuilt += 1
+				with open(files[idx], "rb") as f: shutil.copyfileobj(f, encoder.stdin, 1<<20)
+				log.info("Rendered track %d/%d (%s)", idx + 1, len(tracks), ids[idx][0])
+		finally:
+			encoder.stdin.close()
+			if encoder.wait(): raise subprocess.CalledProcessError(encoder.returncode, "ffmpeg")
+	os.replace("next_glitch.mp3", output)
+	prune(set(files))
+	reused = len(tracks) - rebuilt
+	log.info("Major Glitch segments: %d reused, %d rebuilt", reused, rebuilt)
+	return reused, rebuilt
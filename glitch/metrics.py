@@ -0,0 +1,160 @@
+"""Lightweight metrics, exported in the Prometheus text format
+
+Updating a metric is a dict lookup and an addition (a bisect, for a
+histogram) under an uncontended lock, so they can stay in place in
+production. The lock is there for the web server, whose requests are
+handled on many threads at once. Gauges can be given a
+function instead, which is called only when the metrics are scraped.
+
+	renders = metrics.Counter("glitch_renders_total", "Things rendered", ["kind"])
+	renders.labels("overlay").inc()
+	with metrics.Histogram("glitch_mix_seconds", "Time to mix").time(): ...
+"""
+import time
+import bisect
+import threading
+import contextlib
+
+registry = []
+
+# Default histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def _format_labels(names, values, extra=""):
+	labels = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in zip(names, values)]
+	if extra: labels.append(extra)
+	return "{%s}" % ",".join(labels) if labels else ""
+
+class Metric(object):
+	"""Base class for a metric with zero or more labels
+
+	name: Metric name, eg glitch_listeners
+
+	help: One-line description
+
+	labels: Names of the labels that each child is distinguished by
+	"""
+	type = None
+	def __init__(self, name, help, labels=()):
+		self.name = name
+		self.help = help
+		self.labelnames = tuple(labels)
+		self.children = {}
+		registry.append(self)
+		# Without labels, there's exactly one child, so export it from the start.
+		if not self.labelnames: self.labels()
+
+	def labels(self, *values):
+		"""Get the child for a set of label values, creating it if need be"""
+		try: return self.children[values]
+		except KeyError: pass
+		if len(values) != len(self.labelnames): raise ValueError("Expected labels %r" % (self.labelnames,))
+		# Two threads could both get here; make sure they share one child.
+		return self.children.setdefault(values, self._new_child())
+
+	def samples(self):
+		"""Yield (suffix, labels, value) for every value to be exported"""
+		for values, child in list(self.children.items()):
+			yield "", _format_labels(self.labelnames, values), child.get()
+
+	def render(self):
+		lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+		for suffix, labels, value in self.samples():
+			lines.append("%s%s%s %r" % (self.name, suffix, labels, float(value)))
+		return "\n".join(lines)
+
+	# Unlabelled metrics can be used directly.
+	def inc(self, amount=1): self.labels().inc(amount)
+	def dec(self, amount=1): self.labels().dec(amount)
+	def set(self, value): self.labels().set(value)
+	def observe(self, value): self.labels().observe(value)
+	def time(self): return self.labels().time()
+
+class _Value(object):
+	__slots__ = ("value", "lock")
+	def __init__(self):
+		self.value = 0
+		self.lock = threading.Lock()
+	def inc(self, amount=1):
+		with self.lock: self.value += amount
+	def dec(self, amount=1):
+		with self.lock: self.value -= amount
+	def set(self, value): self.value = value
+	def get(self): return self.value
+
+class Counter(Metric):
+	"""A count that only ever goes up"""
+	type = "counter"
+	_new_child = _Value
+
+class Gauge(Metric):
+	"""A value that can go up and down
+
+	func: If given, a function returning the value (or, for a labelled
+	gauge, a dict mapping tuples of label values to values), called on
+	every scrape. Otherwise, set() the value as it changes.
+	"""
+	type = "gauge"
+	_new_child = _Value
+	def __init__(self, name, help, labels=(), func=None):
+		self.func = func
+		super().__init__(name, help, labels)
+
+	def samples(self):
+		if not self.func:
+			yield from super().samples()
+			return
+		values = self.func()
+		if not self.labelnames: values = {(): values}
+		for labels, value in values.items():
+			yield "", _format_labels(self.labelnames, labels), value
+
+class _Histogram(object):
+	__slots__ = ("buckets", "counts", "sum", "lock")
+	def __init__(self, buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.sum = 0.0
+		self.lock = threading.Lock()
+
+	def observe(self, value):
+		idx = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			self.counts[idx] += 1
+			self.sum += value
+
+	@contextlib.contextmanager
+	def time(self):
+		"""Observe the time taken by the body of a with block"""
+		start = time.perf_counter()
+		try: yield
+		finally: self.observe(time.perf_counter() - start)
+
+class Histogram(Metric):
+	"""A distribution of observed values (usually durations)
+
+	buckets: Upper bounds of the buckets, in ascending order
+	"""
+	type = "histogram"
+	def __init__(self, name, help, labels=(), buckets=BUCKETS):
+		self.buckets = tuple(buckets)
+		super().__init__(name, help, labels)
+
+	def _new_child(self):
+		return _Histogram(self.buckets)
+
+	def samples(self):
+		for values, child in list(self.children.items()):
+			# Take the counts and sum together, so they agree with each other.
+			with child.lock: counts, sum = list(child.counts), child.sum
+			total = 0
+			for bound, count in zip(self.buckets + (float("inf"),), counts):
+				total += count
+				le = 'le="%s"' % ("+Inf" if bound == float("inf") else repr(float(bound)))
+				yield "_bucket", _format_labels(self.labelnames, values, le), total
+			yield "_sum", _format_labels(self.labelnames, values), sum
+			yield "_count", _format_labels(self.labelnames, values), total
+
+def render():
+	"""Everything in the registry, in the Prometheus text format"""
+	return "\n".join(metric.render() for metric in registry) + "\n"
@@ -0,0 +1,168 @@
+"""Transition mixing on raw PCM
+
+pydub makes a new copy of the audio for every slice and every overlay, which
+for the bulk of a track means a complete second copy of it. Here, the audio
+is an int16 NumPy view over the (usually mmapped) PCM buffer; the bulk of a
+track is handed out as a memoryview, and only the overlapping regions are
+actually computed. Positions are in milliseconds and are converted to frames
+exactly the way pydub does it, so the output is sample-for-sample the same.
+
+Run 'python -m glitch.mixer' to compare the speed against pydub.
+"""
+import time
+import numpy
+from . import pcmcache
+
+# Bump this whenever a change could make any different output, so that the
+# Major Glitch's cached segments (see majorglitch.py) get remixed.
+VERSION = 1
+
+# To determine the "effective length" of the last beat, we
+# average the last N beats prior to it. Higher numbers give
+# smoother results but may have issues with a close-out rall.
+LAST_BEAT_AVG = 10
+
+class PCM(object):
+	"""Decoded audio in the canonical format (see pcmcache)"""
+	def __init__(self, data):
+		self.data = memoryview(data).cast("B")
+		self.frames = len(self.data) // pcmcache.FRAME_WIDTH
+		self.samples = numpy.frombuffer(self.data, dtype=numpy.int16).reshape(-1, pcmcache.CHANNELS)
+
+	def __len__(self):
+		"""Length in milliseconds, rounded (as per pydub)"""
+		return round(1000 * self.frames / pcmcache.FRAME_RATE)
+
+	def frame(self, ms):
+		"""Convert a position in ms into a frame number (as per pydub)
+
+		Positions past the end are clamped, and negative ones count
+		back from the end.
+		"""
+		length = len(self)
+		ms = min(ms, length)
+		if ms < 0: ms = length - abs(ms)
+		return int(ms * (pcmcache.FRAME_RATE / 1000.0))
+
+	def slice(self, start=0, end=None):
+		"""Get the raw data from start to end (ms) without copying it
+
+		Rounding can put the end a frame or so beyond the actual data; pydub
+		pads that out with silence, and so do we (which does need a copy).
+		"""
+		start = self.frame(start)
+		end = self.frame(len(self) if end is None else end)
+		data = self.data[start * pcmcache.FRAME_WIDTH : end * pcmcache.FRAME_WIDTH]
+		missing = end - start - len(data) // pcmcache.FRAME_WIDTH
+		if missing > 0: return bytes(data) + bytes(missing * pcmcache.FRAME_WIDTH)
+		return data
+
+	def samples_between(self, start=0, end=None):
+		"""Like slice() but as an array of (frame, channel) samples"""
+		data = self.slice(start, end)
+		if isinstance(data, bytes): return numpy.frombuffer(data, dtype=numpy.int16).reshape(-1, pcmcache.CHANNELS)
+		start = self.frame(start)
+		return self.samples[start : start + len(data) // pcmcache.FRAME_WIDTH]
+
+def overlay(base, over):
+	"""Mix one block of samples over the start of another
+
+	Sums are clamped to the int16 range, as audioop.add does. The result is
+	as long as base; any excess of over is discarded. Returns bytes.
+	"""
+	# pydub's overlay() starts by re-slicing the base segment by its own
+	# length in whole ms, which can gain or lose a frame to rounding. Do
+	# the same, so the two are interchangeable.
+	frames = int(round(1000 * len(base) / pcmcache.FRAME_RATE) * (pcmcache.FRAME_RATE / 1000.0))
+	if frames > len(base): base = numpy.concatenate((base, numpy.zeros((frames - len(base), pcmcache.CHANNELS), numpy.int16)))
+	out = base[:frames].astype(numpy.int32)
+	n = min(len(out), len(over))
+	out[:n] += over[:n]
+	numpy.clip(out, -32768, 32767, out=out)
+	return out.astype(numpy.int16).tobytes()
+
+def boundaries(t1, t2):
+	"""Figure out where one track should hand over to the next
+
+	t1, t2: Analysis objects for the outgoing and incoming tracks
+
+	Returns (t1_end, t2_start, t1_length), all in ms.
+	"""
+	# Note on units:
+	# The beats in an Analysis are (time, duration) pairs in
+	# nanoseconds, straight from amen's Timedelta .value attributes.
+	# We later on will prefer milliseconds, though, so we rescale.
+	# In this code, all variables store ms unless otherwise stated.
+	t1b = t1.beats
+	beat_ns = sum(duration for time, duration in t1b[-1-LAST_BEAT_AVG : -1]) // LAST_BEAT_AVG
+	t1_end = (t1b[-1][0] + beat_ns) // 1000000
+	t1_length = int(t1.duration * 1000)
+	t2_start = t2.beats[1][0] // 1000000
+	return t1_end, t2_start, t1_length
+
+def transition(pcm1, pcm2, skip, t1_end, t2_start, t1_length):
+	"""Mix from one track into the next
+
+	pcm1, pcm2: PCM objects for the outgoing and incoming tracks
+
+	skip: Amount of pcm1 (ms) that has already been played
+
+	t1_end, t2_start, t1_length: As returned by boundaries()
+
+	Returns (bulk, overlay1, overlay2, skip): three buffers to be played in
+	order, and the amount of pcm2 that they cover.
+	"""
+	# 1) Render t1 from skip up to (t1_end-t2_start) - the bulk of the track
+	bulk = pcm1.slice(skip, t1_end - t2_start)
+	# 2) Merge across t2_start ms - this will get us to the downbeat
+	# 3) Merge across (t1_length-t1_end) ms - this nicely rounds out the last track
+	# 4) Go get the next track, but skip the first (t2_start+t1_length-t1_end) ms
+	skip = t2_start + t1_length - t1_end
+	# Overlay the end of one track on the beginning of the other.
+	olay1 = overlay(pcm1.samples_between(t1_end - t2_start, t1_end), pcm2.samples_between(0, t2_start))
+	olay2 = overlay(pcm1.samples_between(t1_end), pcm2.samples_between(t2_start, skip))
+	return bulk, olay1, olay2, skip
+
+def _pydub_transition(dub1, dub2, skip, t1_end, t2_start, t1_length):
+	"""The same as transition(), but on pydub AudioSegments (for comparison)"""
+	bulk = dub1[skip : t1_end - t2_start]
+	skip = t2_start + t1_length - t1_end
+	olay1 = dub1[t1_end - t2_start : t1_end].overlay(dub2[:t2_start])
+	olay2 = dub1[t1_end:].overlay(dub2[t2_start:skip])
+	return bulk.raw_data, olay1.raw_data, olay2.raw_data, skip
+
+def benchmark(seconds=300, runs=5):
+	"""Compare transition() against the equivalent pydub operations
+
+	seconds: Length of the synthetic tracks
+
+	runs: Number of times to run each
+	"""
+	import pydub
+	rng = numpy.random.default_rng(1234)
+	def track():
+		return rng.integers(-32768, 32767, size=(int(seconds * pcmcache.FRAME_RATE), pcmcache.CHANNELS), dtype=numpy.int16).tobytes()
+	data1, data2 = track(), track()
+	# Loud enough that plenty of samples will clip when overlaid
+	args = (1234.0, seconds * 1000 - 2500, 1800, seconds * 1000)
+	def dub(data):
+		return pydub.AudioSegment(data=data, sample_width=pcmcache.SAMPLE_WIDTH,
+			frame_rate=pcmcache.FRAME_RATE, channels=pcmcache.CHANNELS)
+	results = {}
+	for name, func, wrap in (("pydub", _pydub_transition, dub), ("numpy", transition, PCM)):
+		best = None
+		for _ in range(runs):
+			start = time.perf_counter()
+			out = func(wrap(data1), wrap(data2), *args)
+			# Count the cost of getting the data out, too (which for
+			# the bulk memoryview should be all but free).
+			total = sum(len(memoryview(buf)) for buf in out[:3])
+			elapsed = time.perf_counter() - start
+			if best is None or elapsed < best: best = elapsed
+		results[name] = [bytes(buf) for buf in out[:3]] + [out[3]]
+		print("%s: %.2fms per transition (%d bytes)" % (name, best * 1000, total))
+	print("Outputs identical:", results["pydub"] == results["numpy"])
+
+if __name__ == "__main__":
+	import clize
+	clize.run(benchmark)
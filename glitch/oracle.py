@@ -8,7 +8,6 @@ Handle Oracle Question
 """
 import string
 import random
-import operator
 from stop_words import get_stop_words
 from . import database
 
@@ -78,58 +77,19 @@ def get_word_list(question):
 	return [word for word in question.split() if word not in stop_words]
 		
 def popular_words(wordcount=50):
-	popular = {}
-	all_lyrics = database.get_all_lyrics()
-	for lyric in all_lyrics:
-		broken_words = [line for line in lyric.track_lyrics['couplets'] for line in line.split()]
-		remove_punctuation_map = dict((ord(char), None) for char in string.punctuation)
-		words_only = [s.translate(remove_punctuation_map) for s in broken_words]
-
-		for word in broken_words:
-			if word in popular:
-				popular[word] += 1
-			else:
-				popular[word] = 1
-	popular_sorted = sorted(popular.items(), key=operator.itemgetter(1), reverse = True)
-	return popular_sorted[:wordcount]
+	return database.get_popular_words(wordcount)
 				 	
-def compare_to_lyrics(word):
-	track_couplets = []
-	matching_lyrics = database.match_lyrics(word)
-	for lyric in matching_lyrics:
-		for couplet in lyric.track_lyrics['couplets']:
-			couplet_copy = couplet
-			if word.lower() in couplet_copy.lower():
-				track_couplets.append(Couplet(lyric.track_lyrics['artist'], couplet))
-	if len(track_couplets) > 0:
-		return random.choice(track_couplets)
-				
-def compare_to_keywords(word):
-	track_couplets = []
-	matching_lyrics = database.match_keywords(word)
-	for lyric in matching_lyrics:
-		for couplet in lyric.track_lyrics['couplets']:
-			track_couplets.append(Couplet(lyric.track_lyrics['artist'], couplet))
-	if len(track_couplets) > 0:
-		return random.choice(track_couplets)
-						 		
 def get_random():
 	lyric = database.random_lyrics()[0]
 	for couplet in lyric.track_lyrics['couplets']:
 		return Couplet(lyric.track_lyrics['artist'], couplet)
 		
 def the_oracle_speaks(question):
-	wordlist = get_word_list(question)
-	random.shuffle(wordlist)
-	# 1) Try to find a word that comes up in the keywords.
-	for word in wordlist:
-		one = compare_to_keywords(str(word))
-		if one:
-			return one
-	# 2) Failing that, try to find something in the full lyrics.
-	for word in wordlist:
-		two = compare_to_lyrics(str(word))
-		if two:
-			return two
-	# 3) If we still have nothing, be vague.
+	# Look for a couplet with one of the words in it - or better, from a
+	# track whose keywords mention one. One lookup in the couplet index.
+	match = database.match_couplet(get_word_list(question))
+	if match:
+		artist, couplet = match
+		return Couplet(database.Artist(artist), couplet)
+	# If we have nothing, be vague.
 	return Couplet(database.Artist(u"The Glitch Oracle"), random.choice(vague_responses) + "\n ")
@@ -0,0 +1,76 @@
+"""Real-time pacing for the renderer
+
+The mix has to come out at the speed it's heard: too slow and listeners run
+dry, too fast and it runs away from them. The Pacer keeps the rendered audio
+a steady config.frontend_buffer seconds ahead of the clock (which is as far
+ahead as listeners ever get sent), letting it drift by up to
+config.drift_limit before waiting for the clock to catch up, so it isn't
+forever taking tiny naps.
+
+Running behind is harmless as long as it's brief: the mix is rendered far
+faster than real time, so it catches up again straight away. But if the
+renderer stalls for longer than config.lag_limit (eg waiting on a track),
+the audio that should have been heard during the stall never will be; rather
+than have it all arrive in one burst that listeners can't hold, the stream
+resumes from the present, and the timeline is anchored to reflect that.
+"""
+import time
+import asyncio
+import logging
+from . import config, pcmcache, metrics
+
+log = logging.getLogger(__name__)
+
+stalls = metrics.Counter("glitch_pacer_stalls_total", "Times the renderer fell more than lag_limit behind")
+skipped = metrics.Counter("glitch_pacer_skipped_seconds_total", "Dead air skipped after stalls")
+sleeps = metrics.Histogram("glitch_pacer_sleep_seconds", "Time spent waiting for the clock to catch up")
+
+class Pacer(object):
+	"""Keep the renderer a set distance ahead of real time
+
+	timeline: broadcast.Timeline to keep in step with the clock
+
+	lead: Target lead over real time (seconds)
+
+	drift: Distance beyond the target lead before pausing (seconds)
+
+	lag: Maximum time to be behind before skipping ahead (seconds)
+	"""
+	def __init__(self, timeline, lead=config.frontend_buffer, drift=config.drift_limit,
+			lag=config.lag_limit / pcmcache.FRAME_RATE):
+		self.timeline = timeline
+		self.target = lead
+		self.drift = drift
+		self.lag = lag
+		self.position = 0.0 # Stream position (seconds) rendered so far
+
+	@property
+	def rendered_until(self):
+		"""Wall-clock time at which the rendered audio runs out"""
+		return self.timeline.wall_time(self.position)
+
+	@property
+	def lead(self):
+		"""How far ahead of real time we are (negative if behind)"""
+		return self.rendered_until - time.time()
+
+	def check(self):
+		"""Call before rendering. Skips ahead if we've fallen too far behind."""
+		now = time.time()
+		behind = now - self.rendered_until
+		if behind <= self.lag: return
+		log.warning("Renderer stalled; skipping %.2fs of dead air at position %.2f", behind, self.position)
+		stalls.inc()
+		skipped.inc(behind)
+		self.timeline.anchor(self.position, now)
+		self.timeline.trim(now - config.past_played_buffer)
+
+	async def advance(self, seconds):
+		"""Account for audio just rendered, and wait if we're far enough ahead"""
+		self.position += seconds
+		lead = self.lead
+		if lead <= self.target + self.drift: return
+		delay = lead - self.target
+		log.debug("Sleeping for %.2fs (lead %.2fs)", delay, lead)
+		with sleeps.time():
+			await asyncio.sleep(delay)
@@ -0,0 +1,98 @@
+"""Decoded-PCM cache for the renderer
+
+Decoding an MP3 is expensive, and keeping the decoded result on the heap is
+worse (a 400-second track is 70MB of samples). Instead, every track is decoded
+once into canonical stereo s16le at FRAME_RATE, and the file is mmapped for
+playing; the OS page cache then takes care of keeping the popular ones in
+memory. The cache directory is kept within config.pcm_cache_size bytes by
+discarding the least recently used tracks.
+
+Recency is tracked by file modification time, so the cache needs no state of
+its own and can be shared between processes.
+"""
+import os
+import mmap
+import logging
+import subprocess
+from . import config, utils
+
+log = logging.getLogger(__name__)
+
+# The canonical format of everything in the cache. This is also what gets
+# fed to the encoder, so don't change it without checking renderer.ffmpeg().
+FRAME_RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2
+FRAME_WIDTH = CHANNELS * SAMPLE_WIDTH
+
+def _cache_file(id, source):
+	return os.path.join(config.pcm_cache_dir, "%d_%s.pcm" % (id, source))
+
+def decode(id, filename):
+	"""Ensure that a track is in the cache, and return the cache file name
+
+	id: Track ID
+
+	filename: Audio file name, relative to the audio directory
+	"""
+	source = "audio/" + filename
+	fn = _cache_file(id, utils.file_signature(source))
+	try:
+		# Mark it as recently used.
+		os.utime(fn)
+		return fn
+	except FileNotFoundError:
+		pass
+	log.info("Decoding track %s to PCM", id)
+	os.makedirs(config.pcm_cache_dir, exist_ok=True)
+	# Decode to a temporary name and then rename, so nobody ever sees a
+	# partial file (even if two processes decode the same track at once).
+	tmp = "%s.%d.tmp" % (fn, os.getpid())
+	subprocess.run(["ffmpeg", "-v", "error", "-y", "-i", source,
+		"-f", "s16le", "-ac", str(CHANNELS), "-ar", str(FRAME_RATE), tmp],
+		stdin=subprocess.DEVNULL, check=True)
+	os.replace(tmp, fn)
+	prune(keep=fn)
+	return fn
+
+def open_pcm(fn):
+	"""Map a cache file into memory (read-only)"""
+	with open(fn, "rb") as f:
+		if not os.fstat(f.fileno()).st_size: return b"" # Can't mmap an empty file
+		return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def get(track):
+	"""Get the decoded audio of a track as a read-only buffer"""
+	return open_pcm(decode(track.id, track.filename))
+
+def prune(keep=None):
+	"""Trim the cache down to its configured size
+
+	Superseded versions of tracks (from before the audio file changed) are
+	always removed; after that, the least recently used files go first.
+
+	keep: File name that must not be removed (eg because it's about to be used)
+	"""
+	files = []
+	latest = {}
+	for entry in os.scandir(config.pcm_cache_dir):
+		if not entry.name.endswith(".pcm"): continue
+		st = entry.stat()
+		files.append((st.st_mtime, st.st_size, entry.path))
+		id = entry.name.split("_", 1)[0]
+		if id not in latest or latest[id][0] < st.st_mtime: latest[id] = (st.st_mtime, entry.path)
+	current = {path for mtime, path in latest.values()}
+	if keep: current.add(keep)
+	files.sort()
+	stale = [f for f in files if f[2] not in current]
+	files = [f for f in files if f[2] in current]
+	total = sum(size for mtime, size, path in files)
+	while files and total > config.pcm_cache_size:
+		mtime, size, path = files.pop(0)
+		if path == keep: continue
+		stale.append((mtime, size, path))
+		total -= size
+	for mtime, size, path in stale:
+		log.debug("Dropping %s from the PCM cache", path)
+		try: os.unlink(path)
+		except FileNotFoundError: pass # Someone else got there first
@@ -0,0 +1,163 @@
+"""Lookahead track loading for the renderer
+
+Getting a track ready to play means a database query, an MP3 decode and
+(the first time) a beat analysis. None of that can happen on the event loop,
+since the same loop is feeding every listener. Instead, the next few tracks
+are picked ahead of time, and the heavy lifting is done in a process pool;
+the mixer just takes the next finished track off the front of the line.
+
+Listener requests (see database.enqueue_track) jump the line: the renderer is
+notified of each one, loads it straight away, and plays it at the next
+transition after it's ready.
+"""
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import time
+from . import config, asyncdb, analysis, pcmcache, utils, metrics, scheduler
+
+log = logging.getLogger(__name__)
+
+fetch_time = metrics.Histogram("glitch_track_fetch_seconds", "Time to pick a track from the database")
+decode_time = metrics.Histogram("glitch_track_decode_seconds", "Time to decode a track (or find it in the PCM cache)")
+analysis_time = metrics.Histogram("glitch_track_analysis_seconds", "Time to analyse a track that had no current analysis")
+prefetch_result = metrics.Counter("glitch_prefetch_total", "Tracks taken by the mixer, by whether they were ready", ["result"])
+load_failures = metrics.Counter("glitch_prefetch_failures_total", "Tracks skipped because they couldn't be loaded")
+prefetch_wait = metrics.Histogram("glitch_prefetch_wait_seconds", "Time the mixer waited for the next track")
+
+def _prepare(id, filename, stored):
+	"""Get a track ready to play. Runs in a worker process.
+
+	Ensures that the decoded audio is in the PCM cache, and returns its file
+	name, along with the serialized analysis and the audio file signature it
+	belongs to. If the stored analysis is still valid, it is returned
+	unchanged. Also returns the time taken to decode and to analyse (None if
+	it didn't need to), since the worker's own metrics aren't the ones that
+	get exported.
+	"""
+	start = time.perf_counter()
+	fn = pcmcache.decode(id, filename)
+	decoded = time.perf_counter() - start
+	source = utils.file_signature("audio/" + filename)
+	if analysis.load(stored, source): return fn, stored, source, decoded, None
+	log.info("Analyzing track %s", id)
+	start = time.perf_counter()
+	data = analysis.dump(analysis.analyse("audio/" + filename), source)
+	return fn, data, source, decoded, time.perf_counter() - start
+
+class Prefetcher(object):
+	"""Pick and load tracks ahead of the mixer
+
+	depth: Number of upcoming tracks to have picked and loading at once
+
+	workers: Number of worker processes for decoding and analysis
+	"""
+	def __init__(self, depth=config.prefetch_depth, workers=config.prefetch_workers):
+		self.depth = depth
+		self.pool = concurrent.futures.ProcessPoolExecutor(workers)
+		self.scheduler = scheduler.Scheduler()
+		self.pending = collections.deque() # Futures for (track, analysis, pcm), in play order
+		self.requests = collections.deque() # Likewise for listener requests, which go first
+		self.changed = asyncio.Condition()
+		self.stats = {"hits": 0, "misses": 0, "wait": 0.0}
+
+	async def run(self):
+		"""Keep the lookahead full. Doesn't return."""
+		listener = asyncio.ensure_future(self.listen())
+		delay = config.restart_timeout
+		try:
+			while True:
+				async with self.changed:
+					await self.changed.wait_for(lambda: len(self.pending) < self.depth)
+				start = time.perf_counter()
+				try:
+					track = await self.scheduler.next_track()
+				except Exception:
+					# The mixer will be waiting on us, so keep trying, but
+					# don't hammer the database if it's down.
+					log.exception("Unable to pick a track; retrying in %ds", delay)
+					await asyncio.sleep(delay)
+					delay = min(delay * 2, config.prefetch_retry_limit)
+					continue
+				delay = config.restart_timeout
+				fetch_time.observe(time.perf_counter() - start)
+				async with self.changed:
+					self.pending.append(asyncio.ensure_future(self._load(track)))
+					self.changed.notify_all()
+		finally:
+			listener.cancel()
+
+	async def listen(self):
+		"""Start loading listener requests as soon as they're made. Doesn't return."""
+		while True:
+			try:
+				async for _ in asyncdb.notifications("track_queue"):
+					while True:
+						claimed = await asyncdb.claim_request()
+						if not claimed: break
+						id, track = claimed
+						if not track:
+							log.warning("Requested track %s is no longer available", id)
+							continue
+						log.info("Loading requested track %s", track.id)
+						self.scheduler.played(track.id)
+						self.requests.append(asyncio.ensure_future(self._load(track)))
+			except Exception:
+				log.exception("Lost track of the request queue; reconnecting")
+				await asyncio.sleep(config.restart_timeout)
+
+	async def _load(self, track):
+		loop = asyncio.get_event_loop()
+		stored = await asyncdb.get_analysis(track.id)
+		fn, data, source, decoded, analysed = await loop.run_in_executor(self.pool, _prepare, track.id, track.filename, stored)
+		decode_time.observe(decoded)
+		if analysed is not None: analysis_time.observe(analysed)
+		if data != stored: await asyncdb.save_analysis(track.id, data)
+		# Opening the file is quick, but decoding isn't, so if the cache has
+		# been pruned in the meantime (possibly by another process), that
+		# has to go back to the pool.
+		try:
+			pcm = pcmcache.open_pcm(fn)
+		except FileNotFoundError:
+			fn = await loop.run_in_executor(self.pool, pcmcache.decode, track.id, track.filename)
+			pcm = pcmcache.open_pcm(fn)
+		return track, analysis.load(data, source), pcm
+
+	async def next_track(self):
+		"""Get the next track, waiting for it to finish loading if need be
+
+		Returns (track, analysis, pcm).
+		"""
+		# A request is played as soon as it's ready, but never waited for.
+		while self.requests and self.requests[0].done():
+			fut = self.requests.popleft()
+			if fut.exception():
+				log.error("Unable to play requested track", exc_info=fut.exception())
+				continue
+			return fut.result()
+		start = time.monotonic()
+		while True:
+			async with self.changed:
+				# It's a hit if the track was ready and waiting for us.
+				hit = bool(self.pending) and self.pending[0].done()
+				await self.changed.wait_for(lambda: self.pending)
+				fut = self.pending.popleft()
+				self.changed.notify_all() # Let the picker replace it
+			try:
+				result = await fut
+				break
+			except Exception:
+				# Deleted since it was picked, audio file gone, database
+				# restarted... whatever it is, just play something else.
+				log.exception("Unable to load track; skipping it")
+				load_failures.inc()
+		wait = time.monotonic() - start
+		self.stats["hits" if hit else "misses"] += 1
+		self.stats["wait"] += wait
+		prefetch_result.labels("hit" if hit else "miss").inc()
+		prefetch_wait.observe(wait)
+		log.info("Prefetch %s for track %s after %.3fs (%d hits, %d misses, %.1fs waiting)",
+			"hit" if hit else "miss", result[0].id, wait,
+			self.stats["hits"], self.stats["misses"], self.stats["wait"])
+		return result
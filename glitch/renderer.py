@@ -1,23 +1,28 @@
 from aiohttp import web
-import amen.audio
-import pydub
-import os
 import time
 import asyncio
 import logging
-import subprocess
-from . import database
-
-# To determine the "effective length" of the last beat, we
-# average the last N beats prior to it. Higher numbers give
-# smoother results but may have issues with a close-out rall.
-LAST_BEAT_AVG = 10
+from . import config, pcmcache, prefetch, mixer, broadcast, hls, metrics, status, pacing
 
 app = web.Application()
 
-songs = []
-position = 0
-track_list = []
+# Encoded audio, ready to go out to listeners, in every format on offer
+streams = [broadcast.Stream(*stream) for stream in config.streams]
+history = status.History() # What's been playing, for /status.json
+
+mix_time = metrics.Histogram("glitch_mix_seconds", "Time to mix a transition")
+drain_time = metrics.Histogram("glitch_encoder_wait_seconds", "Time spent waiting for the encoders to accept PCM")
+render_lead = metrics.Gauge("glitch_render_lead_seconds", "How far the mix is ahead of real time",
+	func=lambda: pacer.lead)
+target_lead = metrics.Gauge("glitch_render_target_lead_seconds", "How far the mix should be ahead of real time",
+	func=lambda: pacer.target)
+ring_depth = metrics.Gauge("glitch_ring_seconds", "Audio available in each stream's ring buffer", ["format", "bitrate"],
+	func=lambda: {(s.format, s.bitrate): s.ring.duration for s in streams})
+listeners = metrics.Gauge("glitch_listeners", "Listeners currently connected", ["format", "bitrate"])
+bytes_sent = metrics.Counter("glitch_sent_bytes_total", "Audio sent to listeners", ["format", "bitrate"])
+skips = metrics.Counter("glitch_listener_skips_total", "Listeners forced to skip ahead after falling behind")
+disconnects = metrics.Counter("glitch_listener_disconnects_total", "Listeners who went away")
+subscribers = metrics.Gauge("glitch_event_subscribers", "Clients connected to /events")
 
 def route(url):
 	def deco(f):
@@ -27,185 +32,202 @@ def route(url):
 
 # ------ Helper functions for infinitely_glitch() -------
 
-# The rate-limiting sleep will wait until the clock catches up to this point.
-# We start it "ten seconds ago" so we get a bit of buffer to start off.
-rendered_until = time.time() - 10
-ffmpeg = None # aio subprocess where we're compressing to MP3
-async def _render_output_audio(seg, fn):
-	logging.info("Sending %d bytes of data for %s secs of %s", len(seg.raw_data), seg.duration_seconds, fn)
-	ffmpeg.stdin.write(seg.raw_data)
-	await ffmpeg.stdin.drain()
-	global rendered_until; rendered_until += seg.duration_seconds
-	delay = rendered_until - time.time()
-	if delay > 0:
-		logging.debug("And sleeping for %ds until %s", delay, rendered_until)
-		await asyncio.sleep(delay)
-
-def _get_track():
+# The stream starts now, and stays config.frontend_buffer seconds ahead of the
+# clock; see pacing.py.
+timeline = broadcast.Timeline(time.time())
+pacer = pacing.Pacer(timeline)
+encoders = [] # aio subprocesses where we're compressing the mix
+async def _render_output_audio(data, fn):
+	data = memoryview(data)
+	seconds = len(data) / pcmcache.FRAME_WIDTH / pcmcache.FRAME_RATE
+	logging.info("Sending %d bytes of data for %s secs of %s", len(data), seconds, fn)
+	# Go in small blocks, so the pacer can keep a steady lead rather than
+	# jumping ahead by a whole track at a time.
+	block = int(config.pacing_block * pcmcache.FRAME_RATE) * pcmcache.FRAME_WIDTH
+	for start in range(0, len(data), block):
+		piece = data[start:start + block]
+		pacer.check()
+		# The same PCM goes to every encoder; the buffer is shared, not copied.
+		for encoder in encoders: encoder.stdin.write(piece)
+		with drain_time.time():
+			await asyncio.gather(*(encoder.stdin.drain() for encoder in encoders))
+		await pacer.advance(len(piece) / pcmcache.FRAME_WIDTH / pcmcache.FRAME_RATE)
+
+prefetcher = None # prefetch.Prefetcher, created when rendering starts
+segmenter = None # hls.Segmenter, if HLS output is enabled
+
+async def _get_track():
 	"""Get a track and load everything we need."""
-	# TODO: Have proper async database calls (if we can do it without
-	# massively breaking encapsulation); psycopg2 has an async mode, and
-	# aiopg links that in with asyncio.
-	nexttrack = database.get_track_to_play()
-	if not nexttrack.id: return nexttrack, None, None
+	nexttrack, t2, pcm = await prefetcher.next_track()
 	# TODO: Allow an admin-controlled fade at beginning and/or end of a track.
 	# This would be configured with attributes on the track object, and could
 	# be saved long-term, but prob not worth it. See fade_in/fade_out methods.
-	dub2 = pydub.AudioSegment.from_mp3("audio/" + nexttrack.filename).set_channels(2)
-	# NOTE: Calling amen with a filename invokes a second load from disk,
-	# duplicating work done above. However, it will come straight from the
-	# disk cache, so the only real duplication is the decode-from-MP3; and
-	# timing tests show that this is a measurable but not overly costly
-	# addition on top of the time to do the actual analysis. KISS.
-	t2 = amen.audio.Audio("audio/" + nexttrack.filename)
 	# TODO: Equalize volume?
-	return nexttrack, t2, dub2
+	return nexttrack, t2, mixer.PCM(pcm)
 
 async def infinitely_glitch():
+	global prefetcher; prefetcher = prefetch.Prefetcher()
+	picker = asyncio.ensure_future(prefetcher.run())
 	try:
-		nexttrack, t2, dub2 = _get_track()
+		nexttrack, t2, pcm2 = await _get_track()
 		skip = 0.0
 		while True:
-			track = nexttrack; t1 = t2; dub1 = dub2
-			nexttrack, t2, dub2 = _get_track()
-			if not nexttrack.id:
-				# No more tracks. Render the last track to the very end.
-				await _render_output_audio(dub1[skip:], track.filename)
-				break
+			track = nexttrack; t1 = t2; pcm1 = pcm2
+			nexttrack, t2, pcm2 = await _get_track()
 			# Combine this into the next track.
-			# 1) Analyze using amen
-			#    t1 = amen.audio.Audio(track.filename)
+			# 1) Analyze using amen (or load the saved analysis)
 			# 2) Locate the end of the effective last beat
-			#    t1.timings['beats'][-10:-1][*].duration -> avg
-			#    t1_end = t1.timings['beats'][-1].time + avg_duration
+			#    t1.beats[-10:-1][*].duration -> avg
+			#    t1_end = t1.beats[-1].time + avg_duration
 			# 3) Locate the first beat of the next track
-			#    t2 = amen.audio.Audio(nexttrack.filename)
-			#    t2_start = t2.timings['beats'][0].time
+			#    t2_start = t2.beats[0].time
 			# 4) Count back from the end of the last beat
 			#    t1_end - t2_start
 			# 5) Overlay from that point to t1_end to t2_start
-
-			# Note on units:
-			# The Timedelta that we find in timings['beats'] can provide us
-			# with float total_seconds(), or with a .value in nanoseconds.
-			# We later on will prefer milliseconds, though, so we rescale.
-			# In this code, all variables store ms unless otherwise stated.
-			t1b = t1.timings['beats']
-			beat_ns = sum(b.duration.value for b in t1b[-1-LAST_BEAT_AVG : -1]) // LAST_BEAT_AVG
-			t1_end = (t1b[-1].time.value + beat_ns) // 1000000
-			t1_length = int(t1.duration * 1000)
-			t2_start = t2.timings['beats'][1].time.value // 1000000
-			# 1) Render t1 from skip up to (t1_end-t2_start) - the bulk of the track
-			bulk = dub1[skip : t1_end - t2_start]
-			track_list.append({
-				"id": track.id,
-				"start_time": rendered_until,
-				"details": track.track_details,
-			})
+			# See mixer.boundaries() and mixer.transition() for the details.
+			with mix_time.time():
+				bulk, olay1, olay2, skip = mixer.transition(pcm1, pcm2, skip, *mixer.boundaries(t1, t2))
+			pacer.check() # In case the track took too long to get to us
+			history.append(track, pacer.rendered_until)
+			# Start HLS segments on track boundaries too.
+			if segmenter: segmenter.cut_at(pacer.position)
 			await _render_output_audio(bulk, track.filename)
-			# 2) Merge across t2_start ms - this will get us to the downbeat
-			# 3) Merge across (t1_length-t1_end) ms - this nicely rounds out the last track
-			# 4) Go get the next track, but skip the first (t2_start+t1_length-t1_end) ms
-			skip = t2_start + t1_length - t1_end
-			# Overlay the end of one track on the beginning of the other.
-			olayout1 = dub1[t1_end - t2_start : t1_end]
-			olayin1 = dub2[:t2_start]
-			olay1 = olayout1.overlay(olayin1)
-			olayout2 = dub1[t1_end:]
-			olayin2 = dub2[t2_start:skip]
-			olay2 = olayout2.overlay(olayin2)
 			await _render_output_audio(olay1, "overlay 1")
 			await _render_output_audio(olay2, "overlay 2")
 	finally:
-		# Or maybe terminating because we're done rendering the one-shot?
 		logging.warn("Infinite Glitch coroutine terminating due to exception")
-		ffmpeg.stdin.close()
+		picker.cancel()
+		for encoder in encoders: encoder.stdin.close()
 
 # ------ Main renderer coroutine -------
 
 async def ffmpeg():
 	logging.debug("renderer started")
-	global ffmpeg
-	ffmpeg = await asyncio.create_subprocess_exec("ffmpeg", "-ac", "2", "-f", "s16le", "-i", "-", "-f", "mp3", "-",
-		stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	for stream in streams:
+		await stream.start()
+		encoders.append(stream.process)
+	if config.hls_dir:
+		global segmenter
+		segmenter = hls.Segmenter(_find_stream("mp3", config.hls_bitrate), timeline)
+		asyncio.ensure_future(segmenter.run())
 	asyncio.ensure_future(infinitely_glitch())
-	totdata = 0
 	logging.debug("Waiting for data from ffmpeg...")
-	chunk = b""
-	try:
-		while ffmpeg.returncode is None:
-			data = await ffmpeg.stdout.read(4096)
-			if not data: break
-			totdata += len(data)
-			chunk += data
-			# logging.debug("Received %d bytes [%d]", totdata, len(data))
-			if data.startswith(b"\xFF\xFB") and len(chunk) > 1024*1024:
-				global position
-				songs.append(chunk)
-				logging.debug("Adding another song section [%d, %d bytes]", len(songs) + position, len(chunk))
-				chunk = b""
-				if len(songs) > 32:
-					songs.pop(0)
-					position += 1
-	finally:
-		if ffmpeg.returncode is None:
-			logging.warn("Terminating FFMPEG due to renderer exception")
-			ffmpeg.terminate()
+	# Every stream's ring buffer shares the one timeline, so a given
+	# moment in the mix is the same position in all of them.
+	await asyncio.gather(*(stream.pump() for stream in streams))
 	logging.warn("Main renderer coroutine terminating")
 
 # ------ End of main renderer. Simpler stuff follows. :) -------
 
-@route("/all.mp3")
+def _find_stream(format, bitrate):
+	"""Pick the stream to send: the requested bitrate if we have it, else the closest"""
+	candidates = [stream for stream in streams if stream.format == format]
+	if not candidates: return None
+	if bitrate is None: return candidates[0]
+	return min(candidates, key=lambda stream: abs(stream.bitrate - bitrate))
+
+@route("/all.{format}")
 async def moosic(req):
-	logging.debug("/all.mp3 requested")
+	logging.debug("%s requested", req.path)
+	try: bitrate = int(req.query["bitrate"]) if "bitrate" in req.query else None
+	except ValueError: raise web.HTTPBadRequest(text="Bitrate must be a number (kbps)")
+	stream = _find_stream(req.match_info["format"], bitrate)
+	if not stream: raise web.HTTPNotFound()
+	ring = stream.ring
 	resp = web.StreamResponse()
-	resp.content_type = "audio/mpeg"
+	resp.content_type = stream.content_type
+	# Players that can show a title will ask for it to be sent inline.
+	icy = None
+	if stream.format == "mp3" and req.headers.get("Icy-MetaData") == "1":
+		icy = broadcast.IcyInserter(config.icy_metaint)
+		resp.headers["icy-metaint"] = str(config.icy_metaint)
+	def send(data, position):
+		if not icy: return resp.write(data)
+		# Title the data with whatever is heard at its start.
+		for piece in icy.insert(data, history.icy_at(timeline.wall_time(position))): resp.write(piece)
 	await resp.prepare(req)
-	pos = position
-	while True:
-		if pos - position >= len(songs):
-			# Not enough content. This should only happen
-			# on startup, so we just queue ourselves a bit.
-			await asyncio.sleep(1)
-			continue
-		if pos < position:
-			# The client is so far behind that we've dropped
-			# the chunk that would have been next. There's
-			# really not much we can do; disconnect.
-			break
-		logging.debug("songs %d, pos %d, position %d", len(songs), pos, position)
-		resp.write(songs[pos - position])
-		await resp.drain()
-		pos += 1
+	# Wait for there to be something to send. This should only
+	# take any time on startup.
+	await ring.wait_for(ring.first_seq)
+	listening = listeners.labels(stream.format, stream.bitrate)
+	sent = bytes_sent.labels(stream.format, stream.bitrate)
+	listening.inc()
+	try:
+		# Start the listener at whatever should be heard right now. The first
+		# send will be a burst of up to frontend_buffer seconds, to fill up
+		# the client's buffer; after that, we send at real-time speed.
+		seq, offset = ring.locate(timeline.position(time.time()))
+		# Decoders need the stream header (eg the Ogg Opus headers) first.
+		if ring.header: send(ring.header, ring.position(seq, offset))
+		while True:
+			now = time.time()
+			if seq < ring.first_seq or ring.position(seq, offset) < timeline.position(now - config.frontend_buffer):
+				# The client is so far behind that it'll have run out of
+				# audio already (or we've even dropped the chunk that would
+				# have been next). Skip it ahead to the present.
+				logging.debug("Listener fell behind, skipping ahead from chunk %d", seq)
+				skips.inc()
+				seq, offset = ring.locate(timeline.position(now))
+			await ring.wait_for(seq)
+			length = len(ring.get(seq))
+			position = ring.position(seq, offset)
+			data, offset = ring.read(seq, offset, timeline.position(now + config.frontend_buffer))
+			if data:
+				send(data, position)
+				sent.inc(len(data))
+				await resp.drain()
+			if offset >= length:
+				seq += 1; offset = 0
+			else:
+				# We're as far ahead as we want to be. Wait until the
+				# next frame is due (but don't wake up for every frame).
+				due = timeline.wall_time(ring.position(seq, offset)) - config.frontend_buffer
+				await asyncio.sleep(max(due - time.time(), config.stream_pace))
+	finally:
+		listening.dec()
+		disconnects.inc()
 	return resp
 
+@route("/metrics")
+async def export_metrics(req):
+	return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+		headers={"Cache-Control": "no-cache"})
+
 @route("/status.json")
 async def info(req):
 	logging.debug("/status.json requested")
-	# TODO: Clean up the track list, ditching entries way in the past.
-	# It doesn't need to be an ever-growing history.
-	return web.json_response({
-		"ts": time.time(), "render_time": rendered_until,
-		"tracks": track_list
-	}, headers={"Access-Control-Allow-Origin": "*"})
-
-async def render_all():
-	"""Render the entire track as a one-shot"""
-	global rendered_until; rendered_until = 0 # Disable the delay
-	logging.debug("enqueueing all tracks")
-	database.enqueue_all_tracks()
-	logging.debug("renderer started")
-	global ffmpeg
-	ffmpeg = await asyncio.create_subprocess_exec("ffmpeg", "-y", "-ac", "2", "-f", "s16le", "-i", "-", "next_glitch.mp3",
-		stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
-	asyncio.ensure_future(infinitely_glitch())
-	await ffmpeg.wait()
-	os.replace("next_glitch.mp3", "major_glitch.mp3")
-
-def major_glitch():
-	loop = asyncio.get_event_loop()
-	loop.run_until_complete(render_all())
-	loop.close()
+	headers = {"Access-Control-Allow-Origin": "*", "Cache-Control": "no-cache"}
+	try: since = float(req.query["since"]) if "since" in req.query else None
+	except ValueError: raise web.HTTPBadRequest(text="since must be a timestamp", headers=headers)
+	now = time.time()
+	headers["ETag"] = history.etag(now)
+	if req.headers.get("If-None-Match") == headers["ETag"]:
+		return web.Response(status=304, headers=headers)
+	return web.Response(text=history.render(now, pacer.rendered_until, since),
+		content_type="application/json", headers=headers)
+
+@route("/events")
+async def events(req):
+	"""Push new track_list entries to the client as they happen"""
+	resp = web.StreamResponse(headers={"Content-Type": "text/event-stream",
+		"Cache-Control": "no-cache", "Access-Control-Allow-Origin": "*"})
+	await resp.prepare(req)
+	# A reconnecting client tells us the last event it got, and receives
+	# only what it missed. New clients get the whole (recent) history.
+	last = history.last_seen(req.headers.get("Last-Event-ID"))
+	subscribers.inc()
+	try:
+		while True:
+			if history.version > last:
+				for event in history.events_after(last): resp.write(event)
+				last = history.version
+				await resp.drain()
+			elif not await history.wait(config.sse_keepalive):
+				# Proxies will drop a connection that's been silent for too long.
+				resp.write(b": keepalive\n\n")
+				await resp.drain()
+	finally:
+		subscribers.dec()
 
 def run(port=8889):
 	asyncio.ensure_future(ffmpeg())
@@ -0,0 +1,118 @@
+"""Track selection for the renderer
+
+Rather than sorting the whole catalogue for every pick, the active tracks are
+loaded once into a heap keyed on when each was last played (then how often,
+then a random tiebreak), so the next track is always the one that has waited
+longest, found in O(log n). A brand new track has never been played, so it
+gets its turn promptly - and then goes to the back of the line like any
+other, instead of being played to death while its play count catches up.
+
+The heap holds only IDs; the track itself is fetched when it's picked, so
+edits show up, and a track deactivated in the meantime is just passed over.
+The list of active tracks is refreshed every config.scheduler_refresh
+seconds, and plays are saved to the database in batches.
+"""
+import heapq
+import random
+import time
+import logging
+import collections
+from . import config, asyncdb
+
+log = logging.getLogger(__name__)
+
+class Scheduler(object):
+	"""Decide what to play next
+
+	window: Don't pick a track again within this many picks (if the
+	catalogue is big enough to allow it)
+
+	batch: Save play history after this many plays
+	"""
+	def __init__(self, window=config.repeat_window, batch=config.history_batch):
+		self.window = window
+		self.batch = batch
+		self.heap = []
+		self.entries = {} # id: the current heap entry for it; others are stale
+		self.recent = collections.deque() # IDs of the latest picks, newest last
+		self.plays = {} # id: (plays, last played) not yet saved
+		self.refreshed = None # time.monotonic() of the last refresh
+
+	def _push(self, id, played, last_played):
+		entry = (last_played, played, random.random(), id)
+		self.entries[id] = entry
+		heapq.heappush(self.heap, entry)
+
+	async def _refresh(self):
+		"""Bring the set of active tracks up to date"""
+		if self.refreshed is None:
+			for id, played, last_played in await asyncdb.get_schedule():
+				self._push(id, played, last_played)
+			log.info("Scheduler loaded %d tracks", len(self.entries))
+		else:
+			active = await asyncdb.get_active_ids()
+			for id in set(self.entries) - active: del self.entries[id]
+			added = active - set(self.entries)
+			if added:
+				for id, played, last_played in await asyncdb.get_schedule(added):
+					self._push(id, played, last_played)
+				log.info("Scheduler added %d tracks", len(added))
+			# Every so often, rebuild the heap without all the stale entries.
+			if len(self.heap) > 2 * len(self.entries) + 16:
+				self.heap = list(self.entries.values())
+				heapq.heapify(self.heap)
+		self.refreshed = time.monotonic()
+
+	def played(self, id):
+		"""Record a play of a track, whether picked or requested"""
+		now = time.time()
+		entry = self.entries.get(id)
+		if entry: self._push(id, entry[1] + 1, now)
+		self.recent.append(id)
+		while len(self.recent) > self.window: self.recent.popleft()
+		self.plays[id] = (self.plays.get(id, (0, 0))[0] + 1, now)
+
+	async def next_track(self):
+		"""Pick the next track and count it as played
+
+		Listener requests don't come through here; see prefetch.Prefetcher.
+		"""
+		if self.refreshed is None or time.monotonic() - self.refreshed > config.scheduler_refresh:
+			await self._refresh()
+		if len(self.plays) >= self.batch: await self.flush()
+		# Recently-played tracks are set aside rather than picked, unless
+		# there's nothing else - which with a small enough catalogue, there
+		# won't be.
+		recent = set(self.recent)
+		if len(recent) >= len(self.entries): recent = set()
+		skipped = []
+		try:
+			while True:
+				if not self.heap: raise ValueError("Database is empty, cannot enqueue track")
+				entry = heapq.heappop(self.heap)
+				id = entry[3]
+				if self.entries.get(id) is not entry: continue # Stale
+				if id in recent:
+					skipped.append(entry)
+					continue
+				track = await asyncdb.get_active_track(id)
+				if track: break
+				# Deactivated since the last refresh
+				del self.entries[id]
+		finally:
+			for entry in skipped: heapq.heappush(self.heap, entry)
+		log.info("Automatically picking track %s.", track.id)
+		self.played(track.id)
+		return track
+
+	async def flush(self):
+		"""Save the play history"""
+		if not self.plays: return
+		plays, self.plays = self.plays, {}
+		try:
+			await asyncdb.record_plays(plays)
+		except Exception:
+			# Keep them for the next batch; the show must go on.
+			log.exception("Unable to save play history; will retry")
+			for id, (count, last) in plays.items():
+				self.plays[id] = (self.plays.get(id, (0, 0))[0] + count, max(last, self.plays.get(id, (0, 0))[1]))
@@ -1,6 +1,6 @@
-from flask import Flask, render_template, request, redirect, url_for, Response, send_from_directory, jsonify, flash
+from flask import Flask, render_template, request, redirect, url_for, Response, send_from_directory, jsonify, flash, session, abort
 from flask_login import LoginManager, current_user, login_user, logout_user, login_required
-from werkzeug.utils import secure_filename
+from werkzeug.utils import secure_filename, safe_join
 from werkzeug.urls import url_quote_plus
 from urllib.parse import urlparse, urljoin
 import os
@@ -9,8 +9,9 @@ import time
 import datetime
 import random
 import functools
+import hashlib
 import subprocess
-from . import config, database, oracle, utils, mailer
+from . import config, database, oracle, utils, mailer, metrics, cache
 
 app = Flask(__name__)
 
@@ -62,46 +63,90 @@ def couplet_count(lyrics):
 		total += count.track_lyrics['couplet_count']
 	return total
 
-@app.route("/")
-def home():
+def _home_data():
 	lyrics = database.get_all_lyrics()
-	complete_length = datetime.timedelta(seconds=int(database.get_complete_length()))
+	return {
+		"lyrics": lyrics,
+		"couplet_count": couplet_count(lyrics),
+		"complete_length": datetime.timedelta(seconds=int(database.get_complete_length())),
+	}
+
+def _render_home():
 	return render_template("index.html",
 		open=True, # Can have this check for server load if we ever care
 		endpoint="http://localhost:8889/all.mp3", # TODO: Make configurable (or better still, multiplex the port)
-		complete_length=complete_length,
-		couplet_count=couplet_count(lyrics),
-		lyrics=lyrics,
 		og_url=config.server_domain,
 		og_description=og_description,
-		meta_description=meta_description
+		meta_description=meta_description,
+		**cache.get("home_data", _home_data)
 	)
 
-def _make_route(dir):
+@app.route("/")
+def home():
+	# The page itself is the same for every anonymous visitor - unless
+	# there's a message being flashed at them.
+	if current_user.is_anonymous and not session.get("_flashes"):
+		return cache.get("home_page", _render_home)
+	return _render_home()
+
+_etags = {} # file name: (utils.file_signature(), hash of its contents)
+
+def _content_etag(fn):
+	"""Get the ETag for a file, hashing it only if it has changed"""
+	signature = utils.file_signature(fn)
+	cached = _etags.get(fn)
+	if cached and cached[0] == signature: return cached[1]
+	hash = hashlib.md5()
+	with open(fn, "rb") as f:
+		for block in iter(lambda: f.read(1<<20), b""): hash.update(block)
+	_etags[fn] = signature, hash.hexdigest()
+	return _etags[fn][1]
+
+def _make_route(dir, immutable):
 	# Use a closure to early-bind the 'dir'
-	def non_caching_statics(path):
-		response = send_from_directory("../"+dir, path)
-		response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate, max-age=0'
-		response.headers['Pragma'] = 'no-cache'
+	directory = os.path.join(app.root_path, "..", dir)
+	def statics(path):
+		fn = safe_join(directory, path)
+		if fn is None or not os.path.isfile(fn): abort(404)
+		# Conditional responses handle Range requests (for seeking) and
+		# If-None-Match, and the file itself is sent with sendfile where
+		# the server supports it.
+		response = send_from_directory(directory, path, etag=_content_etag(fn), conditional=True)
+		if immutable: response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+		else: response.headers['Cache-Control'] = 'no-cache'
 		return response
-	app.add_url_rule('/'+dir+'/<path:path>', 'non_caching_'+dir, non_caching_statics)
-for _dir in ("audio", "audition_audio", "transition_audio"):
-	# audition_audio and transition_audio aren't currently used, but
-	# will be part of the admin panel that we haven't yet ported.
-	_make_route(_dir)
+	app.add_url_rule('/'+dir+'/<path:path>', 'statics_'+dir, statics)
+# Track files are named for their IDs, and never rewritten once uploaded.
+_make_route("audio", True)
+# audition_audio and transition_audio aren't currently used, but will be
+# part of the admin panel that we haven't yet ported. Their files get
+# regenerated, so browsers have to check back (and get a 304 if unchanged).
+_make_route("audition_audio", False)
+_make_route("transition_audio", False)
 
 @app.route("/artwork/<int:id>.jpg")
 def track_artwork(id):
-	art = database.get_track_artwork(int(id))
 	# TODO: If the track hasn't been approved yet, return 404 unless the user is an admin.
-	if not art:
+	# Artwork is identified by its hash, so a browser that has it already
+	# gets a 304, without the image even leaving the database.
+	row = database.get_track_artwork(int(id), list(request.if_none_match.as_set()))
+	if not row or not row[0]:
 		return redirect('../static/img/Default-artwork-200.png')
-	return bytes(art)
+	digest, art = row
+	if art is None: response = Response(status=304)
+	else: response = Response(bytes(art), mimetype="image/jpeg")
+	response.set_etag(digest)
+	response.headers['Cache-Control'] = 'no-cache'
+	return response
 
 @app.route("/timing.json")
 def timing():
 	return jsonify({"time": time.time() * 1000})
 
+@app.route("/metrics")
+def export_metrics():
+	return Response(metrics.render(), mimetype="text/plain", headers={"Cache-Control": "no-cache"})
+
 @app.route("/credits")
 def credits():
 	og_description="The world's longest recorded pop song. (Credits)"
@@ -159,6 +204,18 @@ def login_post():
 	if not is_safe_url(url): url = "/"
 	return redirect(url)
 
+@app.route("/enqueue/<int:id>", methods=["POST"])
+@login_required
+def enqueue(id):
+	"""Request that the renderer play a track as soon as it can"""
+	error = database.enqueue_track(id, current_user.id)
+	# The track after the current one has already been lined up by the time
+	# we hear about it, so the earliest a request can play is the one after.
+	flash(error or "Coming right up! Track %s will play after the next one." % id)
+	url = request.referrer or "/"
+	if not is_safe_url(url): url = "/"
+	return redirect(url)
+
 @app.route("/logout")
 def logout():
 	logout_user()
@@ -318,7 +375,9 @@ def oracle_get():
 @app.route("/gmin")
 @admin_required
 def admin():
-	all_tracks = database.get_many_mp3("all", "sequence, id")
+	# The page only shows whether each track has lyrics and a story.
+	all_tracks = database.get_many_mp3("all", "sequence, id", columns=("id", "filename",
+		"artist", "length", "status", "sequence", "left(lyrics, 1) AS lyrics", "left(story, 1) AS story"))
 	return render_template("administration.html", all_tracks=all_tracks)
 
 @app.route("/rebuild_glitch")
@@ -366,7 +425,9 @@ def page_not_found(e):
 def run(port=config.http_port, disable_logins=False):
 	if disable_logins:
 		app.config['LOGIN_DISABLED'] = True
-	app.run(host="0.0.0.0", port=port)
+	# Each request checks out its own database connection (see database.py),
+	# so they can be handled concurrently.
+	app.run(host="0.0.0.0", port=port, threaded=True)
 
 if __name__ == '__main__':
 	run()
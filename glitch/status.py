@@ -0,0 +1,124 @@
+"""Recent track history, as served by the renderer's /status.json
+
+Every browser polls /status.json, so the answer is assembled from entries
+that were each serialized once, when the track started, and the history is
+trimmed to config.past_played_buffer seconds. The only per-request work is
+splicing in the current time.
+
+Clients decide which tracks are still current by comparing the response's
+"ts" against each track's start_time and length. A cached response (with its
+stale "ts") is thus only as good as a fresh one if no track has finished in
+the meantime, so the ETag covers both the list and how many of its tracks
+have finished.
+
+Browsers can instead subscribe to /events, and get each new entry pushed to
+them as a Server-Sent Event. The event is encoded once, and handed to all the
+subscribers, who are woken by a single shared asyncio.Event.
+
+The same goes for the ICY metadata blocks that go in the MP3 stream for
+players that ask for it; see broadcast.IcyInserter.
+"""
+import json
+import time
+import bisect
+import asyncio
+from . import config
+
+# The parts of track_details that clients show (see static/main.js).
+CLIENT_DETAILS = ("artist", "length", "story", "url")
+
+def icy_metadata(track):
+	"""Encode a StreamTitle for a track as an ICY metadata block"""
+	details = track.track_details
+	title = details["title"]
+	if details["artist"]: title = "%s - %s" % (details["artist"], title)
+	# There's no escaping in the format, so don't let the title end it early.
+	data = ("StreamTitle='%s';" % title.replace("'", "\u2019")).encode("utf-8")[:255 * 16]
+	blocks = -(-len(data) // 16)
+	return bytes([blocks]) + data.ljust(blocks * 16, b"\0")
+
+class History(object):
+	"""Tracks that have been played recently or are about to be
+
+	keep: Seconds to keep a track after it has finished
+	"""
+	def __init__(self, keep=config.past_played_buffer):
+		self.keep = keep
+		self.starts = [] # start_time of each entry, ascending
+		self.ends = [] # start_time + length, as the clients reckon it
+		self.entries = [] # JSON for each entry
+		self.events = [] # (id, encoded SSE message) for each entry
+		self.icy = [] # ICY metadata block for each entry
+		self.version = 0 # Bumped whenever the list changes; also the latest event number
+		# Event IDs are "epoch-number", so that a client reconnecting after a
+		# restart (when the numbers start over) can be told apart.
+		self.epoch = "%x" % int(time.time() * 1000)
+		self._published = asyncio.Event()
+
+	def append(self, track, start_time):
+		"""Record that a track starts (or started) at the given time"""
+		details = track.track_details
+		entry = {"id": track.id, "start_time": start_time, "details": {key: details[key] for key in CLIENT_DETAILS}}
+		self.starts.append(start_time)
+		self.ends.append(start_time + (details["length"] or 0))
+		self.entries.append(json.dumps(entry))
+		self.icy.append(icy_metadata(track))
+		self.events.append((self.version + 1, ("id: %s-%d\nevent: track\ndata: %s\n\n" % (self.epoch, self.version + 1, self.entries[-1])).encode("utf-8")))
+		# Drop everything that finished long enough ago. Tracks finish in
+		# the order they start, so that's always a prefix of the list.
+		cutoff = time.time() - self.keep
+		drop = 0
+		while drop < len(self.ends) - 1 and self.ends[drop] < cutoff: drop += 1
+		if drop:
+			for lst in (self.starts, self.ends, self.entries, self.events, self.icy): del lst[:drop]
+		self.version += 1
+		self._published.set()
+		self._published = asyncio.Event()
+
+	def icy_at(self, wall_time):
+		"""Get the ICY metadata block for whatever is heard at the given time"""
+		idx = bisect.bisect_right(self.starts, wall_time) - 1
+		if idx < 0: return None
+		return self.icy[idx]
+
+	def last_seen(self, event_id):
+		"""Find the event number a client has seen up to, from its Last-Event-ID
+
+		Returns -1 (so it gets everything) if there isn't one, or if it's
+		from before a restart.
+		"""
+		epoch, _, number = (event_id or "").partition("-")
+		if epoch != self.epoch: return -1
+		try: number = int(number)
+		except ValueError: return -1
+		return number if 0 <= number <= self.version else -1
+
+	def events_after(self, id):
+		"""Get the encoded events newer than the given event number"""
+		if not self.events: return []
+		# IDs are consecutive, so this is just an offset from the first.
+		return [event for seq, event in self.events[max(id - self.events[0][0] + 1, 0):]]
+
+	async def wait(self, timeout=None):
+		"""Wait for a new entry (or the timeout); returns True if there is one"""
+		try:
+			await asyncio.wait_for(self._published.wait(), timeout)
+			return True
+		except asyncio.TimeoutError:
+			return False
+
+	def finished(self, now):
+		"""Count the entries that a client would consider to be in the past"""
+		return sum(1 for end in self.ends if now > end)
+
+	def etag(self, now):
+		return 'W/"%d-%d"' % (self.version, self.finished(now))
+
+	def render(self, now, render_time, since=None):
+		"""Build the response body
+
+		since: If given, only entries with a later start_time are included
+		"""
+		first = 0 if since is None else bisect.bisect_right(self.starts, since)
+		return '{"ts": %s, "render_time": %s, "tracks": [%s]}' % (
+			json.dumps(now), json.dumps(render_time), ", ".join(self.entries[first:]))
@@ -76,6 +76,15 @@ def daemonize(target, *args):
 	t.daemon = True
 	t.start()
 	
+def file_signature(fn):
+	"""Return a short string that changes whenever the file does.
+
+	Based on size and modification time, so it's cheap to calculate, but
+	a file that's merely touched will look different.
+	"""
+	st = os.stat(fn)
+	return "%x-%x" % (st.st_size, st.st_mtime_ns)
+
 def random_hex():
 	return binascii.b2a_hex(os.urandom(8)).decode("ascii")
 